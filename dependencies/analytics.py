@@ -0,0 +1,120 @@
+import datetime
+from typing import Dict, Optional, Tuple
+
+from odmantic import ObjectId
+from pymongo import UpdateOne
+
+from globals import engine
+from models import Order, OrderStatus, PaymentStatus, Product, SalesRollup
+
+# Statuses of an order whose payment went through and still counts as a sale
+SOLD_STATUSES = [OrderStatus.PROCESSING, OrderStatus.DELIVERING, OrderStatus.COMPLETED]
+SOLD_QUERY = {"status": {"$in": SOLD_STATUSES}, "payments.status": PaymentStatus.PAID}
+ROLLUP_PROJECTION = {"items": 1, "payments": 1, "total_amount": 1, "paid_at": 1, "created_at": 1}
+
+ROLLUP_COUNTERS = ("revenue", "units", "orders")
+
+# (day, product_id, gateway) -> {"revenue", "units", "orders", "category_names": set}
+RollupRows = Dict[Tuple[datetime.datetime, Optional[ObjectId], str], dict]
+
+
+def rollup_day(moment: datetime.datetime) -> datetime.datetime:
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=datetime.UTC)
+
+
+def add_order_rows(
+        rows: RollupRows,
+        order: dict,
+        prices: Dict[ObjectId, float],
+        categories: Dict[ObjectId, list],
+        sign: int = 1,
+):
+    """Accumulate one order into rows, prices and categories fill in items recorded without them"""
+    gateway = next(payment["gateway"] for payment in reversed(order["payments"])
+                   if payment["status"] == PaymentStatus.PAID)
+    day = rollup_day(order.get("paid_at") or order["created_at"])
+
+    def add(product_id, revenue, units, category_names=()):
+        row = rows.setdefault(
+            (day, product_id, gateway), {"revenue": 0.0, "units": 0, "orders": 0, "category_names": set()}
+        )
+        row["revenue"] += sign * revenue
+        row["units"] += sign * units
+        row["orders"] += sign
+        # A reversal takes the counts out, the categories the sale was filed under stay
+        if sign > 0:
+            row["category_names"].update(category_names)
+
+    for item in order["items"]:
+        price = item.get("price")
+        if price is None:
+            price = prices.get(item["product_id"], 0.0)
+        category_names = item.get("category_names")
+        if category_names is None:
+            category_names = categories.get(item["product_id"], [])
+        add(item["product_id"], price * item["quantity"], item["quantity"], category_names)
+
+    add(None, order["total_amount"], sum(item["quantity"] for item in order["items"]))
+
+
+async def product_details(product_ids) -> Tuple[Dict[ObjectId, float], Dict[ObjectId, list]]:
+    products = engine.get_collection(Product).find(
+        {"_id": {"$in": list(product_ids)}}, {"price": 1, "category_names": 1}
+    )
+    prices, categories = {}, {}
+    async for product in products:
+        prices[product["_id"]] = product["price"]
+        categories[product["_id"]] = product.get("category_names", [])
+    return prices, categories
+
+
+def rollup_operations(rows: RollupRows):
+    return [
+        UpdateOne(
+            {"day": day, "product_id": product_id, "gateway": gateway},
+            {
+                "$inc": {name: row[name] for name in ROLLUP_COUNTERS},
+                # Categories at sale time, recategorising a product later never rewrites past days
+                "$addToSet": {"category_names": {"$each": sorted(row["category_names"])}},
+            },
+            upsert=True,
+        )
+        for (day, product_id, gateway), row in rows.items()
+    ]
+
+
+async def _write_order(order: dict, sign: int):
+    product_ids = {item["product_id"] for item in order["items"]}
+    prices, categories = await product_details(product_ids)
+
+    rows = {}
+    add_order_rows(rows, order, prices, categories, sign)
+    await engine.get_collection(SalesRollup).bulk_write(rollup_operations(rows), ordered=False)
+
+
+async def apply_order_rollup(order_id: ObjectId):
+    """Count a paid order in the rollups, safe to call more than once"""
+    order = await engine.get_collection(Order).find_one_and_update(
+        {"_id": order_id, "rollup_applied": {"$ne": True}, **SOLD_QUERY},
+        {"$set": {"rollup_applied": True}},
+        projection=ROLLUP_PROJECTION,
+    )
+    if order is not None:
+        await _write_order(order, 1)
+
+
+async def reverse_order_rollup(order_id: ObjectId):
+    """Take a cancelled order back out of the rollups, safe to call more than once"""
+    order = await engine.get_collection(Order).find_one_and_update(
+        {"_id": order_id, "rollup_applied": True, "status": OrderStatus.CANCELLED},
+        {"$set": {"rollup_applied": False}},
+        projection=ROLLUP_PROJECTION,
+    )
+    if order is not None:
+        await _write_order(order, -1)
+
+
+async def reverse_deleted_order(order: dict):
+    # The order document is gone already, nothing to flip
+    if order.get("rollup_applied"):
+        await _write_order(order, -1)
@@ -0,0 +1,81 @@
+import asyncio
+from typing import Dict, List, Optional
+
+from odmantic import ObjectId
+from pydantic import BaseModel
+from pymongo import UpdateOne
+
+from dependencies.analytics import reverse_order_rollup
+from dependencies.stock import release_order_stock
+from globals import engine
+from models import Order
+
+MAX_BULK_ORDERS = 500
+# Cancelled orders released at once, each release is a few round trips of its own
+RELEASE_CONCURRENCY = 16
+
+
+class BulkOrderResult(BaseModel):
+    order_id: ObjectId
+    ok: bool
+    detail: Optional[str] = None
+
+
+class BulkOrderReport:
+    """Collect per-order outcomes, all planned updates go out in one unordered bulk_write"""
+
+    def __init__(self, order_ids: List[ObjectId]):
+        # Keep request order, drop repeated ids
+        self.order_ids = list(dict.fromkeys(order_ids))
+        self.results: Dict[ObjectId, BulkOrderResult] = {}
+        self.operations: Dict[ObjectId, UpdateOne] = {}
+
+    async def load(self, projection: dict) -> Dict[ObjectId, dict]:
+        orders = engine.get_collection(Order).find({"_id": {"$in": self.order_ids}}, projection)
+        found = {order["_id"]: order async for order in orders}
+        for order_id in self.order_ids:
+            if order_id not in found:
+                self.fail(order_id, "Order not found")
+        return found
+
+    def fail(self, order_id: ObjectId, detail: str):
+        self.results[order_id] = BulkOrderResult(order_id=order_id, ok=False, detail=detail)
+
+    def update(self, order_id: ObjectId, guard: dict, update: dict):
+        # guard: the state the order was validated in, a concurrent change makes the update miss
+        self.operations[order_id] = UpdateOne({"_id": order_id, **guard}, update)
+
+    async def apply(self, applied_query: dict) -> List[ObjectId]:
+        """Write all updates, applied_query matches orders in their new state, returns ids of updated orders"""
+        if not self.operations:
+            return []
+
+        orders = engine.get_collection(Order)
+        result = await orders.bulk_write(list(self.operations.values()), ordered=False)
+
+        applied = list(self.operations)
+        if result.matched_count < len(applied):
+            # Bulk results only have totals, ask which orders ended up in the new state
+            applied = await orders.distinct("_id", {"_id": {"$in": applied}, **applied_query})
+
+        for order_id in self.operations:
+            if order_id in applied:
+                self.results[order_id] = BulkOrderResult(order_id=order_id, ok=True)
+            else:
+                self.fail(order_id, "Order changed concurrently")
+        return applied
+
+    def report(self) -> List[BulkOrderResult]:
+        return [self.results[order_id] for order_id in self.order_ids]
+
+
+async def release_cancelled_orders(order_ids: List[ObjectId]):
+    """Give back the stock of cancelled orders and take them out of the sales rollups"""
+    semaphore = asyncio.Semaphore(RELEASE_CONCURRENCY)
+
+    async def release(order_id: ObjectId):
+        async with semaphore:
+            await release_order_stock(order_id)
+            await reverse_order_rollup(order_id)
+
+    await asyncio.gather(*[release(order_id) for order_id in order_ids])
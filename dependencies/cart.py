@@ -0,0 +1,55 @@
+import datetime
+from typing import Dict, List
+
+from odmantic import ObjectId
+from pymongo import UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
+
+from globals import engine
+from models import Cart
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+async def apply_cart_changes(user_id: ObjectId, changes: Dict[ObjectId, int]):
+    """Apply product_id -> quantity changes atomically in one round-trip, quantity 0 removes the line"""
+    now = datetime.datetime.now(datetime.UTC)
+
+    # Ordered, so the cart exists before the item operations run
+    operations = [UpdateOne(
+        {"user": user_id},
+        {"$set": {"updated_at": now}, "$setOnInsert": {"user": user_id, "items": [], "created_at": now}},
+        upsert=True,
+    )]
+    for product_id, quantity in changes.items():
+        if quantity == 0:
+            operations.append(UpdateOne({"user": user_id}, {"$pull": {"items": {"product_id": product_id}}}))
+            continue
+
+        # Add the line if it's missing, then set its quantity. In this order a concurrent request adding
+        # the same product either pushed it first or finds it, the quantity always lands on the one line
+        operations.append(UpdateOne(
+            {"user": user_id, "items.product_id": {"$ne": product_id}},
+            {"$push": {"items": {"product_id": product_id, "quantity": quantity}}},
+        ))
+        operations.append(UpdateOne(
+            {"user": user_id, "items.product_id": product_id},
+            {"$set": {"items.$.quantity": quantity}},
+        ))
+    operations.append(DeleteOne({"user": user_id, "items": {"$size": 0}}))
+
+    collection = engine.get_collection(Cart)
+    try:
+        await collection.bulk_write(operations)
+    except BulkWriteError as e:
+        # Lost the race creating the cart against a concurrent request, it exists now
+        if e.details["writeErrors"][0]["code"] != DUPLICATE_KEY_ERROR:
+            raise
+        await collection.bulk_write(operations)
+
+
+async def remove_cart_items(cart_id: ObjectId, product_ids: List[ObjectId]):
+    await engine.get_collection(Cart).update_one(
+        {"_id": cart_id},
+        {"$pull": {"items": {"product_id": {"$in": product_ids}}}},
+    )
@@ -0,0 +1,226 @@
+import codecs
+import csv
+import datetime
+import io
+import json
+from enum import Enum
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from fastapi import UploadFile
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from dependencies.categories import ensure_categories
+from dependencies.etag import bump_catalog_version
+from dependencies.product_cache import invalidate_products
+from dependencies.search import strip_html
+from dependencies.streaming import STREAM_BATCH_SIZE, to_ndjson_line, ndjson_response
+from globals import engine
+from models import Product
+
+# Upload read size, only the current chunk and batch are held in memory
+IMPORT_CHUNK_SIZE = 1024 * 1024
+IMPORT_BATCH_SIZE = 1000
+
+# Columns understood by import and written by CSV export, anything else (id, rating, ...) is ignored
+CATALOG_FIELDS = [
+    "sku", "name", "description_html", "thumbnail_url", "media_url",
+    "category_names", "price", "tags", "stock", "status",
+]
+# Separator of list values inside a CSV cell
+LIST_FIELDS = {"category_names", "tags"}
+LIST_SEPARATOR = "|"
+
+
+class CatalogFormat(str, Enum):
+    CSV = "csv"
+    NDJSON = "ndjson"
+
+
+# region Import
+
+def detect_format(file: UploadFile) -> CatalogFormat:
+    if file.content_type == "text/csv" or (file.filename or "").lower().endswith(".csv"):
+        return CatalogFormat.CSV
+    return CatalogFormat.NDJSON
+
+
+async def _iter_lines(file: UploadFile) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    pending = ""
+    while chunk := await file.read(IMPORT_CHUNK_SIZE):
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line
+
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+async def _iter_csv(lines: AsyncIterator[str]) -> AsyncIterator[Tuple[int, Optional[dict], Optional[str]]]:
+    header, record, number = None, "", 0
+    async for line in lines:
+        record = f"{record}\n{line}" if record else line
+        # A quoted value spans lines until its quotes are balanced
+        if record.count('"') % 2:
+            continue
+
+        values = next(csv.reader([record])) if record.strip() else None
+        record = ""
+        if values is None:
+            continue
+        if header is None:
+            header = [name.strip() for name in values]
+            continue
+
+        number += 1
+        row = {}
+        for name, value in zip(header, values):
+            if name not in CATALOG_FIELDS:
+                continue
+            if name in LIST_FIELDS:
+                row[name] = [part.strip() for part in value.split(LIST_SEPARATOR) if part.strip()]
+            elif value != "":
+                row[name] = value
+        yield number, row, None
+
+    if record:
+        yield number + 1, None, "Unterminated quoted value"
+
+
+async def _iter_ndjson(lines: AsyncIterator[str]) -> AsyncIterator[Tuple[int, Optional[dict], Optional[str]]]:
+    number = 0
+    async for line in lines:
+        if not line.strip():
+            continue
+        number += 1
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield number, None, "Invalid JSON"
+            continue
+        if not isinstance(row, dict):
+            yield number, None, "Expected a JSON object"
+            continue
+        yield number, {name: value for name, value in row.items() if name in CATALOG_FIELDS}, None
+
+
+def _validation_detail(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in error.errors())
+
+
+def _upsert(row: dict, now: datetime.datetime) -> Tuple[Product, UpdateOne]:
+    product = Product.model_validate(row)
+
+    # Fields given in the row overwrite, everything else only applies to new products
+    doc = product.model_dump_doc()
+    update = {name: doc[name] for name in row}
+    if "description_html" in row:
+        update["description_text"] = strip_html(product.description_html)
+    update["updated_at"] = now
+    on_insert = {name: value for name, value in doc.items() if name not in update}
+
+    return product, UpdateOne({"sku": product.sku}, {"$set": update, "$setOnInsert": on_insert}, upsert=True)
+
+
+async def _write_batch(batch: Dict[str, Tuple[int, Product, UpdateOne]], totals: dict) -> List[dict]:
+    rows = list(batch.values())
+    errors = []
+    try:
+        result = await engine.get_collection(Product).bulk_write([op for _, _, op in rows], ordered=False)
+        details = result.bulk_api_result
+    except BulkWriteError as e:
+        details = e.details
+        for error in details["writeErrors"]:
+            number, product, _ = rows[error["index"]]
+            errors.append({"event": "error", "row": number, "sku": product.sku, "detail": error["errmsg"]})
+
+    totals["upserted"] += details["nUpserted"]
+    totals["modified"] += details["nModified"]
+    totals["errors"] += len(errors)
+
+    await ensure_categories(name for _, product, _ in rows for name in product.category_names)
+    # Upserts are keyed by sku, look up ids of existing products to drop them from the cache
+    updated = await engine.get_collection(Product).distinct("_id", {"sku": {"$in": list(batch)}})
+    await invalidate_products(*updated)
+
+    return errors
+
+
+async def import_products(file: UploadFile, fmt: CatalogFormat) -> AsyncIterator[bytes]:
+    """Upsert products by sku in unordered batches, yields NDJSON progress, per-row error and done events"""
+    rows = _iter_csv(_iter_lines(file)) if fmt == CatalogFormat.CSV else _iter_ndjson(_iter_lines(file))
+    totals = {"rows": 0, "upserted": 0, "modified": 0, "errors": 0}
+    now = datetime.datetime.now(datetime.UTC)
+
+    # sku -> (row number, product, operation), a sku repeated within a batch keeps its last row
+    batch = {}
+    async for number, row, error in rows:
+        totals["rows"] += 1
+        if error is None:
+            try:
+                product, operation = _upsert(row, now)
+                batch[product.sku] = (number, product, operation)
+            except ValidationError as e:
+                error = _validation_detail(e)
+        if error is not None:
+            totals["errors"] += 1
+            yield to_ndjson_line({"event": "error", "row": number, "sku": (row or {}).get("sku"), "detail": error})
+
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            for event in await _write_batch(batch, totals):
+                yield to_ndjson_line(event)
+            batch = {}
+            yield to_ndjson_line({"event": "progress", **totals})
+
+    if batch:
+        for event in await _write_batch(batch, totals):
+            yield to_ndjson_line(event)
+
+    await bump_catalog_version()
+    yield to_ndjson_line({"event": "done", **totals})
+
+
+# endregion Import
+
+# region Export
+
+def _csv_line(values: list) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(values)
+    return buffer.getvalue()
+
+
+async def _iter_csv_export() -> AsyncIterator[bytes]:
+    yield _csv_line(CATALOG_FIELDS).encode()
+
+    cursor = engine.get_collection(Product).find(
+        {}, {field: 1 for field in CATALOG_FIELDS}, batch_size=STREAM_BATCH_SIZE
+    )
+    lines = []
+    async for doc in cursor:
+        lines.append(_csv_line([
+            LIST_SEPARATOR.join(doc.get(field) or []) if field in LIST_FIELDS else doc.get(field, "")
+            for field in CATALOG_FIELDS
+        ]))
+        if len(lines) >= STREAM_BATCH_SIZE:
+            yield "".join(lines).encode()
+            lines = []
+    if lines:
+        yield "".join(lines).encode()
+
+
+def export_products(fmt: CatalogFormat) -> StreamingResponse:
+    """Stream the catalog in the format import_products reads back"""
+    if fmt == CatalogFormat.NDJSON:
+        return ndjson_response(Product, projection={field: 1 for field in CATALOG_FIELDS})
+
+    return StreamingResponse(_iter_csv_export(), media_type="text/csv", headers={
+        "Content-Disposition": "attachment; filename=products.csv",
+    })
+
+# endregion Export
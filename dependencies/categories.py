@@ -0,0 +1,26 @@
+from typing import Iterable
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from globals import engine
+from models import Category
+
+DUPLICATE_KEY = 11000
+
+
+async def ensure_categories(names: Iterable[str]):
+    # Create missing categories in a single round-trip
+    names = set(names)
+    if not names:
+        return
+
+    try:
+        await engine.get_collection(Category).bulk_write(
+            [UpdateOne({"name": name}, {"$setOnInsert": {"name": name}}, upsert=True) for name in names],
+            ordered=False,
+        )
+    except BulkWriteError as e:
+        # A concurrent request upserted the same new name first, the category exists either way
+        if any(error["code"] != DUPLICATE_KEY for error in e.details["writeErrors"]):
+            raise
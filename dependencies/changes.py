@@ -0,0 +1,72 @@
+from typing import Any, Optional, Tuple
+
+from odmantic import Model
+
+from globals import engine
+
+
+def _diff(before: Any, after: Any, path: str, update: dict, conditions: dict):
+    if before == after:
+        return
+
+    if isinstance(before, dict) and isinstance(after, dict):
+        for key, value in after.items():
+            _diff(before.get(key), value, f"{path}.{key}" if path else key, update, conditions)
+        for key in before.keys() - after.keys():
+            update.setdefault("$unset", {})[f"{path}.{key}" if path else key] = ""
+        return
+
+    if isinstance(before, list) and isinstance(after, list) and len(after) >= len(before):
+        if len(after) > len(before) and after[:len(before)] == before:
+            update.setdefault("$push", {})[path] = {"$each": after[len(before):]}
+            return
+
+        # Only touch the elements that changed
+        for i, (old, new) in enumerate(zip(before, after)):
+            _diff(old, new, f"{path}.{i}", update, conditions)
+        if len(after) > len(before):
+            # $push would conflict with the element updates, $set past the end appends instead.
+            # Guarded on the length, so a concurrent append makes the write miss rather than get overwritten
+            for i in range(len(before), len(after)):
+                update.setdefault("$set", {})[f"{path}.{i}"] = after[i]
+            conditions[f"{path}.{len(before)}"] = {"$exists": False}
+        return
+
+    update.setdefault("$set", {})[path] = after
+
+
+class ChangeTracker:
+    """
+    Snapshot a loaded model and write back only the fields that changed.
+
+    engine.save always rewrites every list and embedded field and cascades into references,
+    this emits $set for changed (nested) fields and $push for appended list items instead.
+    Items appended to a list whose existing items changed too are $set by index, in the same
+    update. Only shrunk lists are rewritten whole.
+    """
+
+    def __init__(self, instance: Model):
+        self.instance = instance
+        self.snapshot = instance.model_dump_doc()
+
+    def changes(self) -> Tuple[dict, dict]:
+        """The update document and the filter conditions it relies on"""
+        update, conditions = {}, {}
+        _diff(self.snapshot, self.instance.model_dump_doc(), "", update, conditions)
+        return update, conditions
+
+    async def save(self, guard: Optional[dict] = None) -> bool:
+        # guard: extra filter conditions, the write is skipped (False) if the stored document no longer matches
+        update, conditions = self.changes()
+        if not update:
+            return False
+
+        result = await engine.get_collection(type(self.instance)).update_one(
+            {**(guard or {}), **conditions, "_id": self.instance.id}, update
+        )
+        if not result.matched_count:
+            return False
+
+        self.snapshot = self.instance.model_dump_doc()
+        object.__setattr__(self.instance, "__fields_modified__", set())
+        return True
@@ -0,0 +1,59 @@
+import datetime
+from hashlib import md5
+from typing import Optional
+
+from fastapi import Request, Response
+from odmantic import ObjectId
+
+from globals import engine
+
+CATALOG_VERSION_ID = "catalog"
+
+# Clients must revalidate, responses depend on the logged-in user's roles
+CACHE_CONTROL = "private, no-cache"
+
+
+def catalog_versions():
+    return engine.database["catalog_versions"]
+
+
+async def get_catalog_version() -> int:
+    doc = await catalog_versions().find_one({"_id": CATALOG_VERSION_ID})
+    return doc["version"] if doc else 0
+
+
+async def bump_catalog_version():
+    """
+    Call after any write that changes what product, category or review listings return.
+
+    Stock and rating counters change with every order and review, they only bump it when
+    availability or the average rating changes. Product listings may show older counts, so their
+    ETags are weak (semantically equivalent, not byte-identical). The product itself (strong ETag
+    from updated_at) is always exact.
+    """
+    await catalog_versions().update_one({"_id": CATALOG_VERSION_ID}, {"$inc": {"version": 1}}, upsert=True)
+
+
+def product_version(product_id: ObjectId, updated_at: Optional[datetime.datetime]) -> str:
+    # Products never written since updated_at existed fall back to their (stable) creation time
+    return (updated_at or product_id.generation_time).isoformat()
+
+
+def make_etag(*parts, weak: bool = False) -> str:
+    tag = f'"{md5(":".join(map(str, parts)).encode()).hexdigest()}"'
+    return f"W/{tag}" if weak else tag
+
+
+def conditional_response(req: Request, response: Response, etag: str) -> Optional[Response]:
+    """Returns a 304 response when the client already has etag, otherwise tags the response"""
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+
+    if_none_match = req.headers.get("if-none-match")
+    if if_none_match:
+        # Weak comparison, as If-None-Match requires
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if etag.removeprefix("W/") in tags or "*" in tags:
+            return Response(status_code=304, headers=headers)
+
+    response.headers.update(headers)
+    return None
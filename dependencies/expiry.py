@@ -0,0 +1,85 @@
+import asyncio
+import datetime
+
+from pymongo import UpdateOne
+
+from dependencies import metrics
+from dependencies.stock import release_order_stock
+from globals import engine, ORDER_SWEEP_BATCH_SIZE, ORDER_SWEEP_MAX_BATCHES
+from models import Order, OrderStatus, PaymentStatus
+
+stats = {
+    "runs": 0,
+    "errors": 0,
+    "expired_total": 0,
+    "last_batch_size": 0,
+    "last_run_at": None,
+    # Seconds the oldest expired order waited past its expire_date, as seen by the last run
+    "lag_seconds": 0.0,
+}
+metrics.register("order_expiry", lambda: dict(stats))
+
+
+async def expire_batch(now: datetime.datetime, batch_size: int) -> int:
+    orders = engine.get_collection(Order)
+    due = {"status": OrderStatus.PENDING_PAYMENT, "expire_date": {"$lte": now}}
+
+    batch = await orders.find(due, {"expire_date": 1}).sort("expire_date", 1).limit(batch_size).to_list(length=None)
+    stats["last_batch_size"] = len(batch)
+    if not batch:
+        return 0
+
+    # Filter repeats the condition, an order paid in the meantime is left alone
+    result = await orders.bulk_write([
+        UpdateOne(
+            {"_id": order["_id"], **due},
+            {"$set": {
+                "status": OrderStatus.CANCELLED,
+                "expire_date": None,
+                "payments.$[payment].status": PaymentStatus.EXPIRED,
+            }},
+            array_filters=[{"payment.status": PaymentStatus.PENDING}],
+        )
+        for order in batch
+    ], ordered=False)
+
+    # Only acts on orders that ended up cancelled and still hold stock
+    await asyncio.gather(*[release_order_stock(order["_id"]) for order in batch])
+
+    # Only the orders actually cancelled, the batch size still drives the paging
+    stats["expired_total"] += result.modified_count
+    return len(batch)
+
+
+async def expire_orders(batch_size: int = ORDER_SWEEP_BATCH_SIZE, max_batches: int = ORDER_SWEEP_MAX_BATCHES) -> int:
+    """Cancel unpaid orders past their expire_date in bounded batches, returns the number of orders handled"""
+    now = datetime.datetime.now(datetime.UTC)
+    stats["runs"] += 1
+    stats["last_run_at"] = now.isoformat()
+
+    oldest = await engine.get_collection(Order).find_one(
+        {"status": OrderStatus.PENDING_PAYMENT, "expire_date": {"$lte": now}},
+        {"expire_date": 1},
+        sort=[("expire_date", 1)],
+    )
+    stats["lag_seconds"] = (
+        (now - oldest["expire_date"].replace(tzinfo=datetime.UTC)).total_seconds() if oldest else 0.0
+    )
+
+    total = 0
+    for _ in range(max_batches):
+        handled = await expire_batch(now, batch_size)
+        total += handled
+        if handled < batch_size:
+            break
+
+    return total
+
+
+async def run_sweeper(interval: int):
+    while True:
+        try:
+            await expire_orders()
+        except Exception:  # noqa, keep sweeping, e.g. database briefly unreachable
+            stats["errors"] += 1
+        await asyncio.sleep(interval)
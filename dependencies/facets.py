@@ -0,0 +1,108 @@
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+from dependencies.pagination import Page, encode_cursor, decode_cursor, keyset_query, keyset_sort, cursor_value
+from globals import engine
+from models import Product
+
+# Lower bounds of the price facet, the last band is open-ended
+PRICE_BANDS = [0, 10, 50, 100, 500, 1000]
+
+
+class FacetCount(BaseModel):
+    value: str
+    count: int
+
+
+class RatingCount(BaseModel):
+    stars: int
+    count: int
+
+
+class PriceBandCount(BaseModel):
+    min: float
+    # None for the last, open-ended band
+    max: Optional[float] = None
+    count: int
+
+
+class Facets(BaseModel):
+    categories: List[FacetCount]
+    ratings: List[RatingCount]
+    prices: List[PriceBandCount]
+
+
+class BrowsePage(Page[Product]):
+    facets: Facets
+
+
+def _price_band(lower, count: int) -> PriceBandCount:
+    upper = PRICE_BANDS.index(lower) + 1
+    return PriceBandCount(
+        min=lower,
+        max=PRICE_BANDS[upper] if upper < len(PRICE_BANDS) else None,
+        count=count,
+    )
+
+
+async def browse_products(
+        match: dict,
+        sort: str,
+        key: Optional[str],
+        descending: bool,
+        limit: int,
+        cursor: Optional[str] = None,
+) -> BrowsePage:
+    """One aggregation round-trip for the page and the facet counts of everything matching"""
+    items_pipeline = []
+    if cursor:
+        value, last_id = decode_cursor(cursor, sort)
+        items_pipeline.append({"$match": keyset_query(key, value, last_id, descending)})
+
+    items_pipeline += [
+        {"$sort": keyset_sort(key, descending)},
+        # One extra document to know whether there is a next page
+        {"$limit": limit + 1},
+    ]
+
+    pipeline = [
+        {"$match": match},
+        {"$facet": {
+            "items": items_pipeline,
+            "categories": [
+                {"$unwind": "$category_names"},
+                {"$group": {"_id": "$category_names", "count": {"$sum": 1}}},
+                {"$sort": {"count": -1, "_id": 1}},
+            ],
+            "ratings": [
+                {"$group": {"_id": {"$round": ["$rating.average", 0]}, "count": {"$sum": 1}}},
+                {"$sort": {"_id": -1}},
+            ],
+            "prices": [
+                {"$bucket": {
+                    "groupBy": "$price",
+                    "boundaries": PRICE_BANDS + [float("inf")],
+                    "output": {"count": {"$sum": 1}},
+                }},
+            ],
+        }},
+    ]
+
+    result = (await engine.get_collection(Product).aggregate(pipeline).to_list(length=1))[0]
+
+    docs = result["items"]
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = encode_cursor(sort, cursor_value(docs[-1], key), docs[-1]["_id"])
+
+    return BrowsePage(
+        items=[Product.model_validate_doc(doc) for doc in docs],
+        next_cursor=next_cursor,
+        facets=Facets(
+            categories=[FacetCount(value=c["_id"], count=c["count"]) for c in result["categories"]],
+            ratings=[RatingCount(stars=r["_id"], count=r["count"]) for r in result["ratings"]],
+            prices=[_price_band(p["_id"], p["count"]) for p in result["prices"]],
+        ),
+    )
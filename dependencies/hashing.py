@@ -0,0 +1,88 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+from dependencies import metrics
+from globals import HASH_WORKERS, HASH_QUEUE_LIMIT
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# bcrypt releases the GIL, threads are enough to keep it off the event loop
+executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="hashing")
+
+stats = {
+    "in_flight": 0,
+    "completed": 0,
+    "rejected": 0,
+    "hash_seconds_total": 0.0,
+    "hash_seconds_max": 0.0,
+    "queue_wait_seconds_total": 0.0,
+    "queue_wait_seconds_max": 0.0,
+}
+
+
+def _collect() -> dict:
+    completed = stats["completed"]
+    return {
+        **stats,
+        "workers": HASH_WORKERS,
+        "queue_limit": HASH_QUEUE_LIMIT,
+        "hash_seconds_avg": stats["hash_seconds_total"] / completed if completed else 0.0,
+        "queue_wait_seconds_avg": stats["queue_wait_seconds_total"] / completed if completed else 0.0,
+    }
+
+
+metrics.register("hashing", _collect)
+
+
+def _timed(timing: dict, func, *args):
+    # Runs in the worker thread, only touches its own timing dict
+    timing["started_at"] = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        timing["finished_at"] = time.perf_counter()
+
+
+def _finished(queued_at: float, timing: dict):
+    # On the event loop, once the thread is done with the job or it was cancelled before it started
+    stats["in_flight"] -= 1
+    if "finished_at" not in timing:
+        return
+
+    wait, took = timing["started_at"] - queued_at, timing["finished_at"] - timing["started_at"]
+    stats["completed"] += 1
+    stats["queue_wait_seconds_total"] += wait
+    stats["queue_wait_seconds_max"] = max(stats["queue_wait_seconds_max"], wait)
+    stats["hash_seconds_total"] += took
+    stats["hash_seconds_max"] = max(stats["hash_seconds_max"], took)
+
+
+async def _submit(func, *args):
+    # Shed load instead of queueing forever behind a login storm
+    if stats["in_flight"] >= HASH_WORKERS + HASH_QUEUE_LIMIT:
+        stats["rejected"] += 1
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server busy, please try again later",
+            headers={"Retry-After": "1"},
+        )
+
+    loop = asyncio.get_running_loop()
+    timing, queued_at = {}, time.perf_counter()
+    future = executor.submit(_timed, timing, func, *args)
+    stats["in_flight"] += 1
+    # The slot is released when the thread is done, a cancelled request doesn't stop a running hash
+    future.add_done_callback(lambda _: loop.call_soon_threadsafe(_finished, queued_at, timing))
+    return await asyncio.wrap_future(future)
+
+
+async def hash_password(password: str) -> str:
+    return await _submit(pwd_context.hash, password)
+
+
+async def verify_password(plain_password: str, password_hash: str) -> bool:
+    return await _submit(pwd_context.verify, plain_password, password_hash)
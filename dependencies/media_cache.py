@@ -0,0 +1,281 @@
+import asyncio
+import mimetypes
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from dependencies import metrics
+from globals import MEDIA_CACHE_DIR, MEDIA_CACHE_DISK_BYTES, MEDIA_CACHE_MEMORY_BYTES, MEDIA_CACHE_MEMORY_ITEM_BYTES
+
+TEMP_SUFFIX = ".part"
+# Temp files untouched for this long were left by a crashed download, newer ones may still be written to
+STALE_TEMP_SECONDS = 3600
+# A file's mtime is the LRU clock shared by all workers, hits refresh it at most this often
+TOUCH_INTERVAL_SECONDS = 60
+
+
+class CachedMedia:
+    def __init__(
+            self,
+            path: str,
+            size: int,
+            content_type: str,
+            data: Optional[bytes] = None,
+            stat: Optional[os.stat_result] = None,
+    ):
+        self.path = path
+        self.size = size
+        self.content_type = content_type
+        # Set for entries small enough to be kept in memory as well
+        self.data = data
+        # Set for disk entries, taken when the file was looked up
+        self.stat = stat
+
+
+class MediaCache:
+    """
+    Two tiers for immutable (content addressed) media, both bounded by bytes.
+
+    Small files are kept in memory, everything up to disk_bytes is kept on disk and served
+    from there with FileResponse (sendfile / pathsend when the server supports it).
+
+    The disk tier may be shared by several workers: files are written under unique temp names
+    and renamed into place. Each worker scans the directory once at startup (oldest mtime first)
+    and from then on keeps a running index of the files it writes or finds, evicting least
+    recently used first once its total is past disk_bytes.
+    """
+
+    def __init__(self, directory: str, disk_bytes: int, memory_bytes: int, memory_item_bytes: int):
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self.memory_bytes = memory_bytes
+        self.memory_item_bytes = memory_item_bytes
+
+        # filename -> entry, in LRU order
+        self.memory: OrderedDict[str, CachedMedia] = OrderedDict()
+        self.memory_used = 0
+        # filename -> size of the files on disk known to this worker, in LRU order
+        self.disk: OrderedDict[str, int] = OrderedDict()
+        self.disk_used = 0
+        # filename -> monotonic time its mtime was last refreshed by this worker
+        self.touched: Dict[str, float] = {}
+        # Single-flight, concurrent misses on the same file wait for one fetch
+        self.inflight: Dict[str, asyncio.Task] = {}
+
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.bytes_served = 0
+        self.evictions = 0
+
+        if self.enabled:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                for name, size in self._scan():
+                    self._remove_all(self._track(name, size))
+            except OSError:
+                # e.g. read-only file system, serve straight from blob storage instead
+                self.disk_bytes = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.disk_bytes > 0
+
+    def _scan(self) -> List[Tuple[str, int]]:
+        """Files on disk as (name, size), least recently used first. Startup only, temp files left by
+        a crashed download are removed here"""
+        now = time.time()
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Evicted by another worker meanwhile
+                    continue
+                if entry.name.endswith(TEMP_SUFFIX):
+                    if now - stat.st_mtime > STALE_TEMP_SECONDS:
+                        _remove(entry.path)
+                    continue
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+
+        files.sort()
+        return [(name, size) for _, name, size in files]
+
+    def _track(self, name: str, size: int) -> List[str]:
+        """Mark name as most recently used, returns the paths to remove to get back under disk_bytes"""
+        previous = self.disk.pop(name, None)
+        if previous is not None:
+            self.disk_used -= previous
+        self.disk[name] = size
+        self.disk_used += size
+
+        evicted = []
+        # The file just tracked is never evicted, cacheable() keeps it under disk_bytes by itself
+        while self.disk_used > self.disk_bytes and len(self.disk) > 1:
+            evicted_name, evicted_size = self.disk.popitem(last=False)
+            self.disk_used -= evicted_size
+            self.touched.pop(evicted_name, None)
+            self.evictions += 1
+            evicted.append(os.path.join(self.directory, evicted_name))
+        return evicted
+
+    def _forget(self, name: str):
+        # Evicted by another worker
+        size = self.disk.pop(name, None)
+        if size is not None:
+            self.disk_used -= size
+        self.touched.pop(name, None)
+
+    @staticmethod
+    def _remove_all(paths: List[str]):
+        for path in paths:
+            _remove(path)
+
+    def _remember(self, name: str, entry: CachedMedia) -> CachedMedia:
+        previous = self.memory.pop(name, None)
+        if previous is not None:
+            self.memory_used -= previous.size
+        self.memory[name] = entry
+        self.memory_used += entry.size
+
+        while self.memory_used > self.memory_bytes and self.memory:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_used -= evicted.size
+            self.evictions += 1
+        return entry
+
+    async def _touch(self, name: str, path: str):
+        now = time.monotonic()
+        if now - self.touched.get(name, -TOUCH_INTERVAL_SECONDS) < TOUCH_INTERVAL_SECONDS:
+            return
+        self.touched[name] = now
+        try:
+            await asyncio.to_thread(os.utime, path)
+        except FileNotFoundError:
+            pass
+
+    async def get(self, name: str) -> Optional[CachedMedia]:
+        entry = self.memory.get(name)
+        if entry is not None:
+            self.memory.move_to_end(name)
+            self.hits_memory += 1
+            return entry
+
+        if not self.enabled:
+            return None
+
+        # Checked on every hit, another worker may have evicted the file
+        path = os.path.join(self.directory, name)
+        try:
+            stat = await asyncio.to_thread(os.stat, path)
+            # Promote, hot small files end up served from memory
+            data = await asyncio.to_thread(_read, path) if stat.st_size <= self.memory_item_bytes else None
+        except FileNotFoundError:
+            self._forget(name)
+            return None
+
+        self.hits_disk += 1
+        # Also picks up files written by other workers since startup
+        evicted = self._track(name, stat.st_size)
+        if evicted:
+            await asyncio.to_thread(self._remove_all, evicted)
+        await self._touch(name, path)
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if data is not None:
+            return self._remember(name, CachedMedia(path, len(data), content_type, data))
+        return CachedMedia(path, stat.st_size, content_type, stat=stat)
+
+    def cacheable(self, size: int) -> bool:
+        return self.enabled and size <= self.disk_bytes
+
+    async def fill(
+            self,
+            name: str,
+            content_type: str,
+            fetch: Callable[[], Awaitable[AsyncIterator[bytes]]],
+    ) -> CachedMedia:
+        """Fetch a missing file to disk once, concurrent callers for the same name share the result"""
+        task = self.inflight.get(name)
+        if task is None:
+            self.misses += 1
+            # Own task, a caller going away doesn't abort the fetch others are waiting for
+            task = asyncio.create_task(self._download(name, content_type, fetch))
+            self.inflight[name] = task
+            task.add_done_callback(lambda done: self._fetched(name, done))
+        return await asyncio.shield(task)
+
+    def _fetched(self, name: str, task: asyncio.Task):
+        self.inflight.pop(name, None)
+        if not task.cancelled():
+            # Mark the exception retrieved, every waiter may have gone already
+            task.exception()
+
+    async def _download(self, name, content_type, fetch) -> CachedMedia:
+        path = os.path.join(self.directory, name)
+        # Unique per download, workers sharing the directory never write to each other's temp files
+        fd, temp_path = await asyncio.to_thread(
+            tempfile.mkstemp, suffix=TEMP_SUFFIX, prefix=f"{name}.", dir=self.directory
+        )
+        file = os.fdopen(fd, "wb")
+        chunks, size = [], 0
+        try:
+            async for chunk in await fetch():
+                await asyncio.to_thread(file.write, chunk)
+                size += len(chunk)
+                # Small files go to memory too, stop collecting once past the limit
+                if chunks is not None and size <= self.memory_item_bytes:
+                    chunks.append(chunk)
+                else:
+                    chunks = None
+            await asyncio.to_thread(file.close)
+            # Atomic, readers never see a partial file
+            await asyncio.to_thread(os.replace, temp_path, path)
+        except BaseException:
+            await asyncio.to_thread(file.close)
+            _remove(temp_path)
+            raise
+
+        self.touched[name] = time.monotonic()
+        evicted = self._track(name, size)
+        if evicted:
+            await asyncio.to_thread(self._remove_all, evicted)
+
+        if chunks is not None:
+            return self._remember(name, CachedMedia(path, size, content_type, b"".join(chunks)))
+        return CachedMedia(path, size, content_type)
+
+    def served(self, length: int):
+        self.bytes_served += length
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "bytes_served": self.bytes_served,
+            "evictions": self.evictions,
+            "memory_bytes": self.memory_used,
+            "memory_entries": len(self.memory),
+            "disk_bytes": self.disk_used,
+            "disk_entries": len(self.disk),
+        }
+
+
+def _read(path: str) -> bytes:
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+media_cache = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_DISK_BYTES, MEDIA_CACHE_MEMORY_BYTES, MEDIA_CACHE_MEMORY_ITEM_BYTES)
+metrics.register("media_cache", media_cache.stats)
@@ -0,0 +1,12 @@
+from typing import Callable, Dict
+
+# Name -> callable returning a JSON serializable snapshot
+collectors: Dict[str, Callable[[], dict]] = {}
+
+
+def register(name: str, collector: Callable[[], dict]):
+    collectors[name] = collector
+
+
+def snapshot() -> dict:
+    return {name: collector() for name, collector in collectors.items()}
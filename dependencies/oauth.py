@@ -5,11 +5,13 @@ import jwt
 from fastapi import HTTPException, status, Request
 from fastapi.security import OAuth2PasswordBearer
 from jwt.exceptions import InvalidTokenError
-from passlib.context import CryptContext
 from pydantic import BaseModel
 
 from odmantic.bson import ObjectId
-from globals import engine, SECRET_KEY, ALGORITHM
+from dependencies import metrics
+from dependencies.cache import TTLCache
+from dependencies.hashing import hash_password
+from globals import engine, SECRET_KEY, ALGORITHM, USER_CACHE_TTL_SECONDS, USER_CACHE_MAX_SIZE
 from models import User
 
 
@@ -23,18 +25,46 @@ class TokenData(BaseModel):
     session: str
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# (user id, jti) -> raw user document
+user_cache = TTLCache(max_size=USER_CACHE_MAX_SIZE, ttl=USER_CACHE_TTL_SECONDS)
+metrics.register("user_cache", user_cache.stats)
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+
+async def get_password_hash(password):
+    return await hash_password(password)
 
 
 async def get_user_by_id(user_id: str) -> Optional[User]:
     return await engine.find_one(User, User.id == ObjectId(user_id))
 
 
+def invalidate_user(user_id: ObjectId | str):
+    user_id = str(user_id)
+    user_cache.pop_where(lambda key: key[0] == user_id)
+
+
+async def get_authenticated_user(user_id: str, session: str) -> Optional[User]:
+    doc = user_cache.get((user_id, session))
+    if doc is not None:
+        # Hydrate a fresh instance every time, handlers are free to mutate request.state.user
+        user = User.model_validate_doc(doc)
+        # Same as a document loaded by the engine, nothing modified yet.
+        # May be stale, never hand it (or a model referencing it) to engine.save, the cascade
+        # would write the cached roles and email back. Use raw writes or ChangeTracker instead.
+        object.__setattr__(user, "__fields_modified__", set())
+        return user
+
+    user = await get_user_by_id(user_id)
+    # Check for password change
+    if user is None or md5(user.password_hash.encode()).hexdigest() != session:
+        return None
+
+    user_cache.set((user_id, session), user.model_dump_doc())
+    return user
+
+
 async def oauth_check_dep(request: Request):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -49,16 +79,15 @@ async def oauth_check_dep(request: Request):
         session: str = payload.get("jti")
         if user_id is None or session is None:
             raise credentials_exception
+        # Refresh tokens are only accepted by /auth/refresh
+        if payload.get("type") == "refresh":
+            raise credentials_exception
         token_data = TokenData(id=user_id, session=session)
     except InvalidTokenError:
         raise credentials_exception
 
-    user = await get_user_by_id(token_data.id)
-
+    user = await get_authenticated_user(token_data.id, token_data.session)
     if user is None:
         raise credentials_exception
-    # Check for password change
-    if md5(user.password_hash.encode()).hexdigest() != token_data.session:
-        raise credentials_exception
 
     request.state.user = user
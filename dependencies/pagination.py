@@ -0,0 +1,92 @@
+import base64
+import binascii
+from typing import Any, Generic, List, Optional, Tuple, TypeVar
+
+from bson import json_util, ObjectId as BsonObjectId
+from fastapi import HTTPException
+from odmantic.bson import ObjectId
+from odmantic.query import SortExpression
+from pydantic import BaseModel
+
+from globals import engine
+
+T = TypeVar("T")
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class Page(BaseModel, Generic[T]):
+    items: List[T]
+    # Pass back as `cursor` to fetch the next page, None on the last page
+    next_cursor: Optional[str] = None
+
+
+def encode_cursor(sort: str, value: Any, last_id: ObjectId) -> str:
+    raw = json_util.dumps({"s": sort, "v": value, "id": last_id})
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str) -> Tuple[Any, ObjectId]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json_util.loads(raw)
+        if data["s"] != sort or not isinstance(data["id"], BsonObjectId):
+            raise ValueError
+        return data["v"], data["id"]
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset_query(key: Optional[str], value: Any, last_id: ObjectId, descending: bool) -> dict:
+    """Match documents after (value, last_id) in (key, _id) order, key None means sorting by _id only"""
+    op = "$lt" if descending else "$gt"
+    if key is None:
+        return {"_id": {op: last_id}}
+
+    return {"$or": [
+        {key: {op: value}},
+        {key: value, "_id": {op: last_id}},
+    ]}
+
+
+def keyset_sort(key: Optional[str], descending: bool) -> SortExpression:
+    direction = -1 if descending else 1
+    if key is None:
+        return SortExpression({"_id": direction})
+    return SortExpression({key: direction, "_id": direction})
+
+
+def cursor_value(doc: dict, key: Optional[str]) -> Any:
+    if key is None:
+        return None
+    for part in key.split("."):
+        doc = doc.get(part) if doc else None
+    return doc
+
+
+async def find_page(
+        model,
+        *queries,
+        sort: str,
+        key: Optional[str],
+        descending: bool,
+        limit: int,
+        cursor: Optional[str] = None,
+) -> Page:
+    """Keyset pagination on (key, _id), cost of a page doesn't depend on how deep it is"""
+    queries = list(queries)
+    if cursor:
+        value, last_id = decode_cursor(cursor, sort)
+        queries.append(keyset_query(key, value, last_id, descending))
+
+    # Fetch one extra document to know whether there is a next page
+    items = await engine.find(model, *queries, sort=keyset_sort(key, descending), limit=limit + 1)
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = encode_cursor(sort, cursor_value(last.model_dump_doc(), key), last.id)
+
+    return Page(items=items, next_cursor=next_cursor)
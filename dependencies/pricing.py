@@ -0,0 +1,50 @@
+from decimal import Decimal
+from typing import List
+
+from pydantic import BaseModel
+
+from globals import engine
+from models import CartItem, Product, ProductStatus
+
+CENT = Decimal("0.01")
+
+
+class PricedItem(BaseModel):
+    item: CartItem
+    product: Product
+    unit_price: Decimal
+    subtotal: Decimal
+
+
+class CartPricing(BaseModel):
+    items: List[PricedItem]
+    # Lines whose product is gone, unpublished or short of stock
+    invalid: List[CartItem]
+    total: Decimal
+
+
+def to_decimal(value: float) -> Decimal:
+    # Go through str, Decimal(float) would keep the binary representation error
+    return Decimal(str(value)).quantize(CENT)
+
+
+async def price_cart(items: List[CartItem]) -> CartPricing:
+    """Resolve all cart lines with a single query"""
+    products = await engine.find(Product, Product.id.in_([item.product_id for item in items])) if items else []
+    products = {product.id: product for product in products}
+
+    priced, invalid = [], []
+    for item in items:
+        product = products.get(item.product_id)
+        if product is None or product.status != ProductStatus.PUBLISHED or product.stock < item.quantity:
+            invalid.append(item)
+            continue
+
+        unit_price = to_decimal(product.price)
+        priced.append(PricedItem(item=item, product=product, unit_price=unit_price, subtotal=unit_price * item.quantity))
+
+    return CartPricing(
+        items=priced,
+        invalid=invalid,
+        total=sum((line.subtotal for line in priced), Decimal("0.00")),
+    )
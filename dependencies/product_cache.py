@@ -0,0 +1,89 @@
+from typing import Optional
+
+import bson
+from odmantic import ObjectId
+from redis import asyncio as redis
+from redis.exceptions import RedisError
+
+from dependencies import metrics
+from dependencies.cache import TTLCache
+from globals import engine, PRODUCT_CACHE_TTL_SECONDS, PRODUCT_CACHE_MAX_SIZE, REDIS_URL
+from models import Product
+
+KEY_PREFIX = "product:"
+
+# L1: product id -> raw product document
+local_cache = TTLCache(max_size=PRODUCT_CACHE_MAX_SIZE, ttl=PRODUCT_CACHE_TTL_SECONDS)
+# L2: shared between instances
+shared_cache = redis.from_url(REDIS_URL) if REDIS_URL else None
+
+shared_stats = {"hits": 0, "misses": 0, "errors": 0}
+
+
+def _collect() -> dict:
+    return {"local": local_cache.stats(), "shared": {**shared_stats, "enabled": shared_cache is not None}}
+
+
+metrics.register("product_cache", _collect)
+
+
+def _hydrate(doc: dict) -> Product:
+    # Fresh instance per caller, nothing modified yet as if loaded by the engine
+    product = Product.model_validate_doc(doc)
+    object.__setattr__(product, "__fields_modified__", set())
+    return product
+
+
+async def _shared_get(key: str) -> Optional[dict]:
+    if shared_cache is None:
+        return None
+    try:
+        raw = await shared_cache.get(KEY_PREFIX + key)
+    except RedisError:
+        shared_stats["errors"] += 1
+        return None
+
+    if raw is None:
+        shared_stats["misses"] += 1
+        return None
+    shared_stats["hits"] += 1
+    return bson.decode(raw)
+
+
+async def _shared_set(key: str, doc: dict):
+    if shared_cache is None:
+        return
+    try:
+        await shared_cache.set(KEY_PREFIX + key, bson.encode(doc), ex=PRODUCT_CACHE_TTL_SECONDS)
+    except RedisError:
+        shared_stats["errors"] += 1
+
+
+async def get_product(product_id: ObjectId) -> Optional[Product]:
+    """Read-through lookup by id, visibility (DRAFT) is left to the caller"""
+    key = str(product_id)
+
+    doc = local_cache.get(key)
+    if doc is None:
+        doc = await _shared_get(key)
+        if doc is None:
+            # Product has no references, a plain find_one is enough
+            doc = await engine.get_collection(Product).find_one({"_id": product_id})
+            if doc is None:
+                return None
+            await _shared_set(key, doc)
+        local_cache.set(key, doc)
+
+    return _hydrate(doc)
+
+
+async def invalidate_products(*product_ids: ObjectId):
+    keys = [str(product_id) for product_id in product_ids]
+    for key in keys:
+        local_cache.pop(key)
+
+    if shared_cache is not None and keys:
+        try:
+            await shared_cache.delete(*[KEY_PREFIX + key for key in keys])
+        except RedisError:
+            shared_stats["errors"] += 1
@@ -0,0 +1,52 @@
+import datetime
+from typing import Dict
+
+from odmantic import ObjectId
+
+from globals import engine
+from models import Product
+
+STAR_COUNTS = ["one_star_count", "two_star_count", "three_star_count", "four_star_count", "five_star_count"]
+
+
+def average_stage() -> dict:
+    # Recompute rating.average from the counters in the same update, 5 until the first review
+    total = {"$add": [f"$rating.{count}" for count in STAR_COUNTS]}
+    weighted = {"$add": [{"$multiply": [stars, f"$rating.{count}"]} for stars, count in enumerate(STAR_COUNTS, 1)]}
+    return {"$set": {"rating.average": {"$cond": [
+        {"$gt": [total, 0]},
+        {"$toInt": {"$round": [{"$divide": [weighted, total]}, 0]}},
+        5,
+    ]}}}
+
+
+def rating_pipeline(counts: Dict[str, object]) -> list:
+    return [
+        {"$set": {**{f"rating.{count}": value for count, value in counts.items()},
+                  "updated_at": datetime.datetime.now(datetime.UTC)}},
+        average_stage(),
+    ]
+
+
+def rating_average(rating: dict) -> int:
+    # Same as average_stage, Python and $round both round half to even
+    counts = [rating.get(count) or 0 for count in STAR_COUNTS]
+    total = sum(counts)
+    return round(sum(stars * count for stars, count in enumerate(counts, 1)) / total) if total else 5
+
+
+async def add_rating(product_id: ObjectId, rating: int, delta: int) -> bool:
+    """Count a review in or out of the product rating, returns whether rating.average changed"""
+    # Single atomic update, concurrent reviews on the same product can't lose each other's counts
+    count = STAR_COUNTS[rating - 1]
+    before = await engine.get_collection(Product).find_one_and_update(
+        {"_id": product_id},
+        rating_pipeline({count: {"$max": [0, {"$add": [{"$ifNull": [f"$rating.{count}", 0]}, delta]}]}}),
+        projection={"rating": 1},
+    )
+    if before is None:
+        return False
+
+    previous = before.get("rating") or {}
+    current = {**previous, count: max(0, (previous.get(count) or 0) + delta)}
+    return rating_average(previous) != rating_average(current)
@@ -0,0 +1,79 @@
+from html.parser import HTMLParser
+from typing import Optional
+
+from dependencies.pagination import Page, encode_cursor, decode_cursor
+from globals import engine
+from models import Product, ProductStatus
+
+SEARCH_SORT = "relevance"
+# Only the best matches are ranked and paginated, relevance this far down is noise anyway
+SEARCH_MAX_RESULTS = 1000
+
+
+class _TextExtractor(HTMLParser):
+    SKIP_TAGS = {"script", "style"}
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skipping += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS and self.skipping:
+            self.skipping -= 1
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.parts.append(data)
+
+
+def strip_html(html: Optional[str]) -> Optional[str]:
+    if not html:
+        return None
+
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return " ".join(" ".join(parser.parts).split())
+
+
+async def search_products(
+        query: str,
+        status: Optional[ProductStatus],
+        limit: int,
+        cursor: Optional[str] = None,
+) -> Page:
+    """Text index search ranked by relevance, paginated on (score, _id) over the top SEARCH_MAX_RESULTS"""
+    match = {"$text": {"$search": query}}
+    if status is not None:
+        match["status"] = status
+
+    pipeline = [
+        {"$match": match},
+        # Sort and limit coalesce into a top-k sort, only SEARCH_MAX_RESULTS documents are ever held
+        {"$sort": {"score": {"$meta": "textScore"}, "_id": 1}},
+        {"$limit": SEARCH_MAX_RESULTS},
+        {"$addFields": {"score": {"$meta": "textScore"}}},
+    ]
+    if cursor:
+        score, last_id = decode_cursor(cursor, SEARCH_SORT)
+        # Still in relevance order, the stages after the sort keep it
+        pipeline.append({"$match": {"$or": [
+            {"score": {"$lt": score}},
+            {"score": score, "_id": {"$gt": last_id}},
+        ]}})
+    # One extra document to know whether there is a next page
+    pipeline.append({"$limit": limit + 1})
+
+    docs = await engine.get_collection(Product).aggregate(pipeline).to_list(length=None)
+
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = encode_cursor(SEARCH_SORT, docs[-1]["score"], docs[-1]["_id"])
+
+    return Page(items=[Product.model_validate_doc(doc) for doc in docs], next_cursor=next_cursor)
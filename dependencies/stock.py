@@ -0,0 +1,88 @@
+import asyncio
+import datetime
+from typing import Dict
+
+from odmantic import ObjectId
+from pymongo import UpdateOne, ReturnDocument
+
+from dependencies.etag import bump_catalog_version
+from dependencies.product_cache import invalidate_products
+from globals import engine
+from models import Order, OrderStatus, Product, ProductStatus
+
+
+async def _stock_changed(product_ids, availability_changed: bool):
+    await invalidate_products(*product_ids)
+    # Product ETags follow updated_at, listings only go stale when a product sells out or comes back
+    if availability_changed:
+        await bump_catalog_version()
+
+
+async def restock(lines: Dict[ObjectId, int]):
+    """Give back product_id -> quantity, used to undo reservations"""
+    if not lines:
+        return
+
+    now = datetime.datetime.now(datetime.UTC)
+    collection = engine.get_collection(Product)
+    await collection.bulk_write([
+        UpdateOne({"_id": product_id}, {"$inc": {"stock": quantity}, "$set": {"updated_at": now}})
+        for product_id, quantity in lines.items()
+    ], ordered=False)
+
+    # Stock no higher than what was given back means it was sold out before
+    back_in_stock = await collection.count_documents(
+        {"$or": [{"_id": product_id, "stock": {"$lte": quantity}} for product_id, quantity in lines.items()]},
+        limit=1,
+    )
+    await _stock_changed(lines, back_in_stock > 0)
+
+
+async def reserve_stock(lines: Dict[ObjectId, int]) -> bool:
+    """
+    Take product_id -> quantity off the stock, all or nothing.
+
+    Each line is a conditional $inc (stock >= quantity), so concurrent orders never oversell and
+    nothing is locked. Lines are sent concurrently rather than in one bulk_write, as bulk results
+    don't tell which lines matched and a partial reservation must be rolled back exactly.
+    """
+    now = datetime.datetime.now(datetime.UTC)
+    collection = engine.get_collection(Product)
+    results = await asyncio.gather(*[
+        collection.find_one_and_update(
+            {"_id": product_id, "status": ProductStatus.PUBLISHED, "stock": {"$gte": quantity}},
+            {"$inc": {"stock": -quantity}, "$set": {"updated_at": now}},
+            projection={"stock": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+        for product_id, quantity in lines.items()
+    ])
+
+    reserved = {
+        product_id: quantity
+        for (product_id, quantity), result in zip(lines.items(), results)
+        if result is not None
+    }
+    if len(reserved) != len(lines):
+        await restock(reserved)
+        return False
+
+    await _stock_changed(lines, any(result["stock"] <= 0 for result in results))
+    return True
+
+
+async def release_order_stock(order_id: ObjectId):
+    """Return the stock held by a cancelled order, safe to call more than once"""
+    order = await engine.get_collection(Order).find_one_and_update(
+        {"_id": order_id, "status": OrderStatus.CANCELLED, "stock_reserved": True},
+        {"$set": {"stock_reserved": False}},
+        projection={"items": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if order is None:
+        return
+
+    lines = {}
+    for item in order["items"]:
+        lines[item["product_id"]] = lines.get(item["product_id"], 0) + item["quantity"]
+    await restock(lines)
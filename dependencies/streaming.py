@@ -0,0 +1,49 @@
+import datetime
+import json
+from typing import Optional, Type
+
+from bson import ObjectId, Decimal128
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+from odmantic import Model
+
+from globals import engine
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# Documents fetched from Mongo per round-trip, memory stays bounded by this
+STREAM_BATCH_SIZE = 500
+
+
+def wants_ndjson(req: Request) -> bool:
+    return NDJSON_MEDIA_TYPE in req.headers.get("accept", "")
+
+
+def _json_default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, Decimal128):
+        return str(value.to_decimal())
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def to_ndjson_line(doc: dict) -> bytes:
+    if "_id" in doc:
+        doc["id"] = doc.pop("_id")
+    return json.dumps(doc, default=_json_default).encode() + b"\n"
+
+
+def ndjson_response(
+        model: Type[Model],
+        query: Optional[dict] = None,
+        projection: Optional[dict] = None,
+) -> StreamingResponse:
+    """Stream raw documents straight from the Motor cursor, references are returned as ids"""
+
+    async def iterate():
+        cursor = engine.get_collection(model).find(query or {}, projection, batch_size=STREAM_BATCH_SIZE)
+        async for doc in cursor:
+            yield to_ndjson_line(doc)
+
+    return StreamingResponse(iterate(), media_type=NDJSON_MEDIA_TYPE)
@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 import certifi
 from dotenv import load_dotenv
@@ -13,17 +14,57 @@ DEBUG = os.getenv('DEBUG', 'false').lower() == 'true'
 ALGORITHM = "HS256"
 SECRET_KEY = os.getenv('JWT_SECRET')
 
-ACCESS_TOKEN_EXPIRE_MINUTES = 4320  # 3 days
+# Access tokens are short-lived, clients renew them with the refresh token via /auth/refresh
+ACCESS_TOKEN_EXPIRE_MINUTES = 15
+REFRESH_TOKEN_EXPIRE_MINUTES = 4320  # 3 days
 REMEMBER_ME_EXPIRE_MINUTES = 10080  # 7 days
 
 # endregion JWT
 
+# region Password hashing
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", "2"))
+# Hash requests allowed to wait for a worker before answering 503
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", "32"))
+
+# endregion Password hashing
+
+# region Cache
+# Authenticated users are cached per instance, keep TTL short as other instances won't see invalidations
+USER_CACHE_TTL_SECONDS = int(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "10000"))
+
+PRODUCT_CACHE_TTL_SECONDS = int(os.getenv("PRODUCT_CACHE_TTL_SECONDS", "30"))
+PRODUCT_CACHE_MAX_SIZE = int(os.getenv("PRODUCT_CACHE_MAX_SIZE", "2000"))
+# Optional shared L2 for the product cache, e.g. redis://localhost:6379/0
+REDIS_URL = os.getenv("REDIS_URL")
+
+# endregion Cache
+
+# region Order expiry
+# Unpaid orders past expire_date are cancelled by dependencies.expiry, 0 disables the in-process sweeper
+ORDER_SWEEP_INTERVAL_SECONDS = int(os.getenv("ORDER_SWEEP_INTERVAL_SECONDS", "60"))
+ORDER_SWEEP_BATCH_SIZE = int(os.getenv("ORDER_SWEEP_BATCH_SIZE", "200"))
+# Upper bound of batches per sweep, the rest waits for the next run
+ORDER_SWEEP_MAX_BATCHES = int(os.getenv("ORDER_SWEEP_MAX_BATCHES", "10"))
+
+# endregion Order expiry
+
 # Database
 DATABASE_URL = os.getenv('DATABASE_URL')
 
 # Media
 BLOB_CONNECTION_STRING = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
 BLOB_CONTAINER_NAME = os.getenv("AZURE_STORAGE_CONTAINER_NAME")
+MEDIA_MAX_UPLOAD_BYTES = int(os.getenv("MEDIA_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+# Uploads are staged as blocks of MEDIA_CHUNK_SIZE, at most MEDIA_UPLOAD_CONCURRENCY in flight per upload
+MEDIA_CHUNK_SIZE = int(os.getenv("MEDIA_CHUNK_SIZE", str(4 * 1024 * 1024)))
+MEDIA_UPLOAD_CONCURRENCY = int(os.getenv("MEDIA_UPLOAD_CONCURRENCY", "4"))
+# Local cache of downloaded media, files are immutable so entries are only evicted for space
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "media-cache"))
+MEDIA_CACHE_DISK_BYTES = int(os.getenv("MEDIA_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))  # 0 disables the cache
+MEDIA_CACHE_MEMORY_BYTES = int(os.getenv("MEDIA_CACHE_MEMORY_BYTES", str(32 * 1024 * 1024)))
+# Only files up to this size are also kept in memory, e.g. thumbnails
+MEDIA_CACHE_MEMORY_ITEM_BYTES = int(os.getenv("MEDIA_CACHE_MEMORY_ITEM_BYTES", str(256 * 1024)))
 
 # Auth
 ALLOW_REGISTRATION = os.getenv("ALLOW_REGISTRATION", "true").lower() == "true"
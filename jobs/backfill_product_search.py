@@ -0,0 +1,47 @@
+"""
+One-shot backfill of Product.description_text for products created before search existed.
+
+Usage: python -m jobs.backfill_product_search
+"""
+import asyncio
+
+from pymongo import UpdateOne
+
+from dependencies.search import strip_html
+from globals import engine
+from models import Product, init_database
+
+BATCH_SIZE = 1000
+
+
+async def backfill():
+    # Build the text index first
+    await init_database()
+
+    products = engine.get_collection(Product)
+    cursor = products.find(
+        {"description_html": {"$ne": None}, "description_text": {"$exists": False}},
+        {"description_html": 1},
+    )
+
+    operations, total = [], 0
+    async for product in cursor:
+        operations.append(UpdateOne(
+            {"_id": product["_id"]},
+            {"$set": {"description_text": strip_html(product["description_html"])}},
+        ))
+        if len(operations) >= BATCH_SIZE:
+            await products.bulk_write(operations, ordered=False)
+            total += len(operations)
+            operations = []
+            print(f"Backfilled {total} products")
+
+    if operations:
+        await products.bulk_write(operations, ordered=False)
+        total += len(operations)
+
+    print(f"Done, backfilled {total} products")
+
+
+if __name__ == "__main__":
+    asyncio.run(backfill())
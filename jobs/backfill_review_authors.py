@@ -0,0 +1,45 @@
+"""
+One-shot backfill of Review.author for reviews written before author snapshots existed.
+
+Usage: python -m jobs.backfill_review_authors
+"""
+import asyncio
+
+from pymongo import UpdateMany
+
+from globals import engine
+from models import Review, User, init_database
+from routers.review import review_author
+
+BATCH_SIZE = 1000
+
+
+async def backfill():
+    # Build the review feed indexes first
+    await init_database()
+
+    reviews = engine.get_collection(Review)
+    user_ids = await reviews.distinct("user", {"author": None})
+
+    total = 0
+    for start in range(0, len(user_ids), BATCH_SIZE):
+        users = engine.get_collection(User).find(
+            {"_id": {"$in": user_ids[start:start + BATCH_SIZE]}}, {"first_name": 1, "last_name": 1, "thumbnail_url": 1}
+        )
+        operations = [UpdateMany(
+            {"user": user["_id"], "author": None},
+            {"$set": {"author": review_author(
+                user["first_name"], user.get("last_name"), user.get("thumbnail_url")
+            ).model_dump()}},
+        ) async for user in users]
+
+        if operations:
+            result = await reviews.bulk_write(operations, ordered=False)
+            total += result.modified_count
+            print(f"Backfilled {total} reviews")
+
+    print(f"Done, backfilled {total} reviews")
+
+
+if __name__ == "__main__":
+    asyncio.run(backfill())
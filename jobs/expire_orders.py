@@ -0,0 +1,29 @@
+"""
+Cancel unpaid orders past their expire_date, mark their pending payment expired and release held stock.
+
+Run it on a schedule where the API's in-process sweeper isn't used (ORDER_SWEEP_INTERVAL_SECONDS=0),
+e.g. the Azure Functions deployment.
+
+Usage: python -m jobs.expire_orders
+"""
+import asyncio
+
+from dependencies.expiry import expire_orders, stats
+from globals import ORDER_SWEEP_BATCH_SIZE, ORDER_SWEEP_MAX_BATCHES
+
+
+async def sweep():
+    # Keep going until the backlog is cleared, not just one bounded run
+    total = 0
+    while True:
+        handled = await expire_orders()
+        total += handled
+        print(f"Expired {total} orders, lag {stats['lag_seconds']:.0f}s")
+        if handled < ORDER_SWEEP_BATCH_SIZE * ORDER_SWEEP_MAX_BATCHES:
+            break
+
+    print(f"Done, expired {total} orders")
+
+
+if __name__ == "__main__":
+    asyncio.run(sweep())
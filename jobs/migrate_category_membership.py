@@ -0,0 +1,47 @@
+"""
+One-shot migration: move category membership from Category.product_ids onto Product.category_names.
+
+Usage: python -m jobs.migrate_category_membership
+"""
+import asyncio
+
+from pymongo import UpdateOne
+
+from globals import engine
+from models import Category, Product, init_database
+
+BATCH_SIZE = 1000
+
+
+async def migrate():
+    # Build the category_names indexes first
+    await init_database()
+
+    categories = engine.get_collection(Category)
+    products = engine.get_collection(Product)
+
+    # Backfill: products listed by a category get the category name
+    async for category in categories.find({"product_ids.0": {"$exists": True}}, {"name": 1, "product_ids": 1}):
+        product_ids = category["product_ids"]
+        for i in range(0, len(product_ids), BATCH_SIZE):
+            await products.update_many(
+                {"_id": {"$in": product_ids[i:i + BATCH_SIZE]}},
+                {"$addToSet": {"category_names": category["name"]}},
+            )
+        print(f"Backfilled {len(product_ids)} products of category {category['name']!r}")
+
+    # Every name used by a product needs a Category document to be listed
+    names = await products.distinct("category_names")
+    if names:
+        result = await categories.bulk_write(
+            [UpdateOne({"name": name}, {"$setOnInsert": {"name": name}}, upsert=True) for name in names],
+            ordered=False,
+        )
+        print(f"Created {result.upserted_count} missing categories")
+
+    result = await categories.update_many({"product_ids": {"$exists": True}}, {"$unset": {"product_ids": ""}})
+    print(f"Dropped product_ids from {result.modified_count} categories")
+
+
+if __name__ == "__main__":
+    asyncio.run(migrate())
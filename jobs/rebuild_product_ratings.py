@@ -0,0 +1,59 @@
+"""
+Recompute Product.rating from the Review collection and repair products whose counters drifted.
+
+Usage: python -m jobs.rebuild_product_ratings
+"""
+import asyncio
+
+from pymongo import UpdateOne
+
+from dependencies.etag import bump_catalog_version
+from dependencies.product_cache import invalidate_products
+from dependencies.ratings import STAR_COUNTS, rating_pipeline
+from globals import engine
+from models import Product, Review
+
+BATCH_SIZE = 1000
+
+
+async def rebuild():
+    # product id -> [one, two, three, four, five]
+    counted = {}
+    async for row in engine.get_collection(Review).aggregate([
+        {"$group": {"_id": {"product": "$product", "rating": "$rating"}, "count": {"$sum": 1}}},
+    ]):
+        counts = counted.setdefault(row["_id"]["product"], [0] * len(STAR_COUNTS))
+        counts[row["_id"]["rating"] - 1] = row["count"]
+
+    products = engine.get_collection(Product)
+    operations, repaired, checked = [], [], 0
+    async for product in products.find({}, {"rating": 1, "reviews": 1}):
+        checked += 1
+        counts = counted.get(product["_id"], [0] * len(STAR_COUNTS))
+        rating = product.get("rating") or {}
+        if [rating.get(count) for count in STAR_COUNTS] == counts and "reviews" not in product:
+            continue
+
+        operations.append(UpdateOne(
+            {"_id": product["_id"]},
+            # Also drops the legacy Product.reviews id list
+            rating_pipeline(dict(zip(STAR_COUNTS, counts))) + [{"$unset": "reviews"}],
+        ))
+        repaired.append(product["_id"])
+        if len(operations) >= BATCH_SIZE:
+            await products.bulk_write(operations, ordered=False)
+            operations = []
+            print(f"Repaired {len(repaired)} of {checked} products")
+
+    if operations:
+        await products.bulk_write(operations, ordered=False)
+
+    if repaired:
+        await invalidate_products(*repaired)
+        await bump_catalog_version()
+
+    print(f"Done, repaired {len(repaired)} of {checked} products")
+
+
+if __name__ == "__main__":
+    asyncio.run(rebuild())
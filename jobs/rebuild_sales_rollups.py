@@ -0,0 +1,65 @@
+"""
+Rebuild SalesRollup from scratch out of the orders, repairs rollups that drifted or predate the feature.
+
+Orders paid while it runs may be counted twice or not at all, run it when checkout is quiet.
+
+Usage: python -m jobs.rebuild_sales_rollups
+"""
+import asyncio
+
+from pymongo import UpdateOne, DeleteOne
+
+from dependencies.analytics import SOLD_QUERY, ROLLUP_PROJECTION, ROLLUP_COUNTERS, add_order_rows, product_details
+from globals import engine
+from models import Order, SalesRollup, init_database
+
+BATCH_SIZE = 1000
+
+
+async def write(collection, operations):
+    for start in range(0, len(operations), BATCH_SIZE):
+        await collection.bulk_write(operations[start:start + BATCH_SIZE], ordered=False)
+
+
+async def rebuild():
+    # Build the rollup indexes first
+    await init_database()
+
+    orders = engine.get_collection(Order)
+    prices, categories = await product_details(await orders.distinct("items.product_id", SOLD_QUERY))
+
+    rows, counted = {}, 0
+    async for order in orders.find(SOLD_QUERY, ROLLUP_PROJECTION):
+        add_order_rows(rows, order, prices, categories)
+        counted += 1
+    print(f"Aggregated {counted} paid orders into {len(rows)} rollup rows")
+
+    rollups = engine.get_collection(SalesRollup)
+    operations = [
+        UpdateOne(
+            {"day": day, "product_id": product_id, "gateway": gateway},
+            {"$set": {
+                **{name: row[name] for name in ROLLUP_COUNTERS},
+                "category_names": sorted(row["category_names"]),
+            }},
+            upsert=True,
+        )
+        for (day, product_id, gateway), row in rows.items()
+    ]
+
+    # Rows left over from orders that no longer count, stored days come back without tzinfo
+    wanted = {(day.replace(tzinfo=None), product_id, gateway) for day, product_id, gateway in rows}
+    async for rollup in rollups.find({}, {"day": 1, "product_id": 1, "gateway": 1}):
+        if (rollup["day"].replace(tzinfo=None), rollup.get("product_id"), rollup["gateway"]) not in wanted:
+            operations.append(DeleteOne({"_id": rollup["_id"]}))
+
+    await write(rollups, operations)
+
+    await orders.update_many({**SOLD_QUERY, "rollup_applied": {"$ne": True}}, {"$set": {"rollup_applied": True}})
+    await orders.update_many({"$nor": [SOLD_QUERY], "rollup_applied": True}, {"$set": {"rollup_applied": False}})
+
+    print(f"Done, wrote {len(rows)} rollup rows")
+
+
+if __name__ == "__main__":
+    asyncio.run(rebuild())
@@ -1,3 +1,4 @@
+import asyncio
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Depends
@@ -5,16 +6,25 @@ from fastapi.middleware.gzip import GZipMiddleware
 
 from dependencies.oauth import oauth_check_dep
 from dependencies.roles import role_customer, role_admin
-from routers import user, product, order, auth, review, category
+from routers import user, product, order, auth, review, category, metrics, analytics
 from routers.frontend import cart, account, shipping, address, checkout, media
 
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
     from models import init_database
+    from dependencies.expiry import run_sweeper
+    from globals import ORDER_SWEEP_INTERVAL_SECONDS
 
     await init_database()
+
+    sweeper = None
+    if ORDER_SWEEP_INTERVAL_SECONDS > 0:
+        # Unpaid order expiry, python -m jobs.expire_orders does the same where background tasks don't live long
+        sweeper = asyncio.create_task(run_sweeper(ORDER_SWEEP_INTERVAL_SECONDS))
     yield
+    if sweeper:
+        sweeper.cancel()
 
 
 app = FastAPI(
@@ -49,6 +59,6 @@ for router in (
     app.include_router(router, dependencies=[Depends(oauth_check_dep), Depends(role_customer)])
 
 for router in (
-        user.router,
+        user.router, metrics.router, analytics.router,
 ):
     app.include_router(router, dependencies=[Depends(oauth_check_dep), Depends(role_admin)])
@@ -2,10 +2,11 @@ import datetime
 from enum import Enum
 from typing import Optional, List
 
-from odmantic import EmbeddedModel, Reference
+import pymongo
+from odmantic import EmbeddedModel, Reference, Index
 from odmantic import Field, Model
 from odmantic.bson import ObjectId
-from pydantic import EmailStr
+from pydantic import EmailStr, SerializationInfo, SerializerFunctionWrapHandler, model_serializer
 
 from globals import engine
 
@@ -53,8 +54,7 @@ class Address(Model):
 
 class Category(Model):
     name: str = Field(unique=True)
-
-    product_ids: List[ObjectId] = Field(default=[])
+    # Membership lives on Product.category_names
 
 
 class ProductStatus(str, Enum):
@@ -76,6 +76,8 @@ class Product(Model):
     sku: str = Field(unique=True)
     name: str = Field(index=True)
     description_html: Optional[str] = None
+    # description_html without markup, maintained on write for the text index
+    description_text: Optional[str] = None
 
     thumbnail_url: Optional[str] = None
     media_url: Optional[str] = None
@@ -86,12 +88,45 @@ class Product(Model):
     # A.K.A Keywords
     tags: List[str] = Field(default=[])
 
-    reviews: List[ObjectId] = Field(default=[])
+    # Counters kept by dependencies.ratings, reviews themselves are only in the Review collection
     rating: ProductRating = Field(default_factory=ProductRating)
 
     stock: int = 0
     status: ProductStatus = ProductStatus.DRAFT
 
+    # Part of the product ETag, set on every write. None on products stored before it, see etag.product_version
+    updated_at: Optional[datetime.datetime] = None
+
+    @model_serializer(mode="wrap")
+    def _hide_derived(self, handler: SerializerFunctionWrapHandler, info: SerializationInfo):
+        data = handler(self)
+        # API responses (json mode) only, model_dump_doc dumps in python mode and still stores it
+        if info.mode == "json":
+            data.pop("description_text", None)
+        return data
+
+    model_config = {
+        "indexes": lambda: [
+            # Keyset pagination, one per sort option, see routers.product.ProductSort
+            Index(Product.status, Product.id, name="status_id"),
+            Index(Product.status, Product.price, Product.id, name="status_price_id"),
+            Index(Product.status, Product.name, Product.id, name="status_name_id"),
+            # Category listing, multikey on category_names
+            Index(Product.category_names, Product.status, Product.id, name="category_status_id"),
+            Index(Product.category_names, Product.status, Product.price, Product.id, name="category_status_price_id"),
+            Index(Product.category_names, Product.status, Product.name, Product.id, name="category_status_name_id"),
+            # Faceted browsing, see dependencies.facets
+            Index(Product.status, Product.tags, Product.price, name="status_tags_price"),
+            Index(Product.status, Product.rating.average, Product.price, name="status_rating_price"),
+            # Search, see dependencies.search
+            pymongo.IndexModel(
+                [("name", pymongo.TEXT), ("tags", pymongo.TEXT), ("description_text", pymongo.TEXT)],
+                weights={"name": 10, "tags": 5, "description_text": 1},
+                name="search_text",
+            ),
+        ],
+    }
+
 
 class OrderStatus(str, Enum):
     PENDING_PAYMENT = "pending_payment"
@@ -116,6 +151,10 @@ class OrderStatus(str, Enum):
 class OrderItem(EmbeddedModel):
     product_id: ObjectId
     quantity: int = Field(default=1, ge=1)
+    # Unit price at checkout, None on orders placed before it was recorded
+    price: Optional[float] = None
+    # Product categories at checkout, sales analytics files the sale under these
+    category_names: Optional[List[str]] = None
 
     review_id: Optional[ObjectId] = None
 
@@ -211,16 +250,45 @@ class Order(Model):
         default_factory=lambda: datetime.datetime.now(datetime.UTC) + datetime.timedelta(hours=24)
     )
     status: OrderStatus = OrderStatus.PENDING_PAYMENT
+    # Items are taken off Product.stock, given back when the order is cancelled
+    stock_reserved: bool = False
+    paid_at: Optional[datetime.datetime] = None
+    # Counted in SalesRollup, flipped atomically so an order is counted (and reversed) once
+    rollup_applied: bool = False
+
+    model_config = {
+        "indexes": lambda: [
+            # Order history, see routers.order.read_my_order_summaries
+            Index(Order.user, Order.status, Order.created_at, Order.id, name="user_status_created_id"),
+            # Unpaid order expiry, see dependencies.expiry
+            Index(Order.status, Order.expire_date, name="status_expire_date"),
+        ],
+    }
+
+
+class ReviewAuthor(EmbeddedModel):
+    full_name: str
+    thumbnail_url: Optional[str] = None
 
 
 class Review(Model):
     user: User = Reference()
     product: Product = Reference()
+    # Display snapshot of the user taken at write time, listing reviews doesn't load users
+    author: Optional[ReviewAuthor] = None
     rating: int = Field(default=5, ge=1, le=5)
 
     comment: Optional[str] = None
     created_at: datetime.datetime = Field(default_factory=lambda: datetime.datetime.now(datetime.UTC))
 
+    model_config = {
+        "indexes": lambda: [
+            # Review feed, see routers.review.ReviewSort
+            Index(Review.product, Review.created_at, Review.id, name="product_created_id"),
+            Index(Review.product, Review.rating, Review.id, name="product_rating_id"),
+        ],
+    }
+
 
 class CartItem(EmbeddedModel):
     product_id: ObjectId
@@ -234,8 +302,58 @@ class Cart(Model):
     created_at: datetime.datetime = Field(default_factory=lambda: datetime.datetime.now(datetime.UTC))
     updated_at: datetime.datetime = Field(default_factory=lambda: datetime.datetime.now(datetime.UTC))
 
+    model_config = {
+        # One cart per user, cart mutations upsert on it
+        "indexes": lambda: [Index(Cart.user, unique=True, name="user_unique")],
+    }
+
+
+# Paid order totals per day x product x gateway, maintained by dependencies.analytics
+class SalesRollup(Model):
+    day: datetime.datetime
+    # None for the whole-order row, which keeps order counts exact when summing across products
+    product_id: Optional[ObjectId] = None
+    gateway: PaymentGateway
+    # Product categories, for grouping by category without joining products
+    category_names: List[str] = Field(default=[])
+
+    revenue: float = 0
+    units: int = 0
+    orders: int = 0
+
+    model_config = {
+        "indexes": lambda: [
+            Index(SalesRollup.day, SalesRollup.product_id, SalesRollup.gateway, unique=True,
+                  name="day_product_gateway_unique"),
+        ],
+    }
+
+
+async def _merge_duplicate_carts():
+    # Carts from before one cart per user was enforced, merged once so Cart's unique index can build
+    carts = engine.get_collection(Cart)
+    if "user_unique" in await carts.index_information():
+        return
+
+    duplicates = carts.aggregate([
+        {"$sort": {"updated_at": -1, "_id": -1}},
+        {"$group": {"_id": "$user", "ids": {"$push": "$_id"}, "items": {"$push": "$items"}}},
+        {"$match": {"ids.1": {"$exists": True}}},
+    ])
+    async for group in duplicates:
+        # The newest cart is kept, a product in several carts keeps its newest quantity
+        items = {}
+        for cart_items in group["items"]:
+            for item in cart_items or []:
+                items.setdefault(item["product_id"], item)
+
+        keep, *merged = group["ids"]
+        await carts.update_one({"_id": keep}, {"$set": {"items": list(items.values())}})
+        await carts.delete_many({"_id": {"$in": merged}})
+
 
 async def init_database():
+    await _merge_duplicate_carts()
     await engine.configure_database([
         User,
         Address,
@@ -244,4 +362,5 @@ async def init_database():
         Order,
         Review,
         Cart,
+        SalesRollup,
     ])
@@ -0,0 +1,87 @@
+import datetime
+from enum import Enum
+from typing import List, Optional
+
+from fastapi import APIRouter, HTTPException, Query
+from pydantic import BaseModel
+
+from globals import engine
+from models import SalesRollup, PaymentGateway
+
+router = APIRouter(prefix="/analytics", tags=["analytics"])
+
+MAX_RANGE_DAYS = 366
+
+
+class SalesGroup(str, Enum):
+    DAY = "day"
+    PRODUCT = "product"
+    CATEGORY = "category"
+    GATEWAY = "gateway"
+
+
+class SalesRow(BaseModel):
+    # Day (YYYY-MM-DD), product id, category name or gateway depending on group_by
+    key: str
+    revenue: float
+    units: int
+    # Exact per day and gateway, per product or category it counts the orders containing them
+    orders: int
+
+
+# Answered from SalesRollup, never scans orders
+@router.get("/sales", response_model=List[SalesRow])
+async def read_sales(
+        start: datetime.date,
+        end: datetime.date,
+        group_by: SalesGroup = SalesGroup.DAY,
+        gateway: Optional[PaymentGateway] = None,
+        category: Optional[str] = None,
+        limit: int = Query(default=100, ge=1, le=1000),
+):
+    if end < start or (end - start).days >= MAX_RANGE_DAYS:
+        raise HTTPException(status_code=400, detail="Invalid date range")
+
+    query = {"day": {
+        "$gte": datetime.datetime.combine(start, datetime.time(), datetime.UTC),
+        "$lte": datetime.datetime.combine(end, datetime.time(), datetime.UTC),
+    }}
+    if gateway:
+        query["gateway"] = gateway
+
+    # Whole-order rows keep order counts exact, product rows are needed once products matter
+    if group_by in (SalesGroup.PRODUCT, SalesGroup.CATEGORY) or category:
+        query["product_id"] = {"$ne": None}
+    else:
+        query["product_id"] = None
+    if category:
+        query["category_names"] = category
+
+    pipeline = [{"$match": query}]
+    match group_by:
+        case SalesGroup.DAY:
+            key = {"$dateToString": {"format": "%Y-%m-%d", "date": "$day"}}
+        case SalesGroup.PRODUCT:
+            key = {"$toString": "$product_id"}
+        case SalesGroup.CATEGORY:
+            pipeline.append({"$unwind": "$category_names"})
+            if category:
+                pipeline.append({"$match": {"category_names": category}})
+            key = "$category_names"
+        case _:
+            key = "$gateway"
+
+    pipeline += [
+        {"$group": {
+            "_id": key,
+            "revenue": {"$sum": "$revenue"},
+            "units": {"$sum": "$units"},
+            "orders": {"$sum": "$orders"},
+        }},
+        {"$sort": {"_id": 1} if group_by == SalesGroup.DAY else {"revenue": -1, "_id": 1}},
+        {"$limit": limit},
+    ]
+
+    rows = await engine.get_collection(SalesRollup).aggregate(pipeline).to_list(length=None)
+    return [SalesRow(key=row["_id"], revenue=round(row["revenue"], 2), units=row["units"], orders=row["orders"])
+            for row in rows]
@@ -9,9 +9,11 @@ from fastapi import HTTPException, status, APIRouter
 from odmantic.exceptions import DuplicateKeyError
 from pydantic import BaseModel, EmailStr
 
-from dependencies.oauth import get_password_hash, pwd_context
-from globals import (engine, ACCESS_TOKEN_EXPIRE_MINUTES, REMEMBER_ME_EXPIRE_MINUTES, SECRET_KEY, ALGORITHM,
-                     ALLOW_REGISTRATION, ALLOW_CHANGE_PASSWORD)
+from dependencies.changes import ChangeTracker
+from dependencies.hashing import verify_password
+from dependencies.oauth import get_password_hash, invalidate_user, get_authenticated_user
+from globals import (engine, ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN_EXPIRE_MINUTES, REMEMBER_ME_EXPIRE_MINUTES,
+                     SECRET_KEY, ALGORITHM, ALLOW_REGISTRATION, ALLOW_CHANGE_PASSWORD)
 from models import User, Address, PhoneNumber
 
 router = APIRouter(prefix="/auth", tags=["auth"])
@@ -20,6 +22,9 @@ router = APIRouter(prefix="/auth", tags=["auth"])
 class Token(BaseModel):
     access_token: str
     token_type: str
+    # Seconds until access_token expires
+    expires_in: int
+    refresh_token: str
 
 
 # region Request Models
@@ -38,6 +43,10 @@ class LoginRequest(BaseModel):
     remember_me: bool = False
 
 
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+
 class ResetPasswordRequest(BaseModel):
     email: EmailStr
 
@@ -47,17 +56,13 @@ class ResetPasswordRequest(BaseModel):
 # region Helper Functions
 
 
-def verify_password(plain_password, password_hash):
-    return pwd_context.verify(plain_password, password_hash)
-
-
 async def get_user_by_email(email: str) -> Optional[User]:
     return await engine.find_one(User, User.email == email)
 
 
 async def authenticate_user(email: str, password: str):
     user = await get_user_by_email(email)
-    if not user or not verify_password(password, user.password_hash):
+    if not user or not await verify_password(password, user.password_hash):
         return False
     return user
 
@@ -73,6 +78,30 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     return encoded_jwt
 
 
+def create_session_token(user: User, token_type: str, expires_delta: timedelta):
+    return create_access_token(
+        data={
+            "sub": user.email,
+            # Password change will change jti, which revokes both access and refresh tokens
+            "jti": md5(user.password_hash.encode()).hexdigest(),
+            "type": token_type,
+            "extra": {
+                "id": str(user.id),
+                "roles": user.roles
+            },
+        }, expires_delta=expires_delta
+    )
+
+
+def create_token_response(user: User, refresh_token: str) -> Token:
+    return Token(
+        access_token=create_session_token(user, "access", timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)),
+        token_type="bearer",
+        expires_in=ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+        refresh_token=refresh_token,
+    )
+
+
 # create_access_token authenticate_user get_password_hash
 
 # endregion Helper Functions
@@ -88,19 +117,35 @@ async def login_for_access_token(
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    expire_minutes = REMEMBER_ME_EXPIRE_MINUTES if request.remember_me else ACCESS_TOKEN_EXPIRE_MINUTES
-    access_token_expires = timedelta(minutes=expire_minutes)
-    access_token = create_access_token(
-        data={
-            "sub": user.email,
-            "jti": md5(user.password_hash.encode()).hexdigest(),
-            "extra": {
-                "id": str(user.id),
-                "roles": user.roles
-            },
-        }, expires_delta=access_token_expires
+    expire_minutes = REMEMBER_ME_EXPIRE_MINUTES if request.remember_me else REFRESH_TOKEN_EXPIRE_MINUTES
+    refresh_token = create_session_token(user, "refresh", timedelta(minutes=expire_minutes))
+    return create_token_response(user, refresh_token)
+
+
+@router.post("/refresh", response_model=Token)
+async def refresh_access_token(request: RefreshRequest) -> Token:
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid Session",
+        headers={"WWW-Authenticate": "Bearer"},
     )
-    return Token(access_token=access_token, token_type="bearer")
+
+    try:
+        payload = jwt.decode(request.refresh_token, SECRET_KEY, algorithms=[ALGORITHM])
+    except jwt.InvalidTokenError:
+        raise credentials_exception
+
+    user_id = payload.get("extra", {}).get("id")
+    session = payload.get("jti")
+    if payload.get("type") != "refresh" or user_id is None or session is None:
+        raise credentials_exception
+
+    # Revocation check only, no bcrypt involved
+    user = await get_authenticated_user(user_id, session)
+    if user is None:
+        raise credentials_exception
+
+    return create_token_response(user, request.refresh_token)
 
 
 @router.post("/register", status_code=201, response_model=User)
@@ -112,7 +157,7 @@ async def register_user(request: RegisterRequest):
         first_name=request.first_name,
         last_name=request.last_name,
         email=request.email,
-        password_hash=get_password_hash(request.password)
+        password_hash=await get_password_hash(request.password)
     )
 
     try:
@@ -149,7 +194,9 @@ async def reset_password(request: ResetPasswordRequest):
     # Feature: Send a password reset email
     # This is a demo app, so just reset with random password
     new_password = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
-    user.password_hash = get_password_hash(new_password)
-    await engine.save(user)
+    changes = ChangeTracker(user)
+    user.password_hash = await get_password_hash(new_password)
+    await changes.save()
+    invalidate_user(user.id)
 
     raise HTTPException(status_code=200, detail=f"Password reset successfully, your new password is: {new_password}")
@@ -1,13 +1,19 @@
 # Display all products
-from typing import List
+import datetime
+from typing import List, Optional
 
-from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi import APIRouter, HTTPException, Depends, Request, Query, Response
 from odmantic.exceptions import DuplicateKeyError
 from pydantic import BaseModel
+from pymongo import UpdateMany, errors
 
+from dependencies.etag import make_etag, conditional_response, get_catalog_version, bump_catalog_version
+from dependencies.product_cache import invalidate_products
+from dependencies.pagination import Page, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
 from dependencies.roles import role_admin
 from globals import engine
-from models import Category, Product, ProductStatus
+from models import Category, Product
+from routers.product import ProductSort, find_product_page
 
 router = APIRouter(prefix="/categories", tags=["categories"])
 
@@ -18,13 +24,13 @@ class CategoryCreate(BaseModel):
 
 # Read all categories
 @router.get("", response_model=List[Category])
-async def read_categories():
-    categories = await engine.find(Category)
+async def read_categories(req: Request, response: Response):
+    not_modified = conditional_response(req, response, make_etag(await get_catalog_version()))
+    if not_modified:
+        return not_modified
 
-    for category in categories:
-        del category.product_ids
+    return await engine.find(Category)
 
-    return categories
 
 # Create a new category
 @router.post("", status_code=201, dependencies=[Depends(role_admin)])
@@ -36,35 +42,76 @@ async def create_category(request: CategoryCreate):
     except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Category already exists")
 
+    await bump_catalog_version()
+
 
 # Read a category by ID
 @router.get("/{category_name}", response_model=Category)
-async def read_category(category_name: str):
+async def read_category(category_name: str, req: Request, response: Response):
+    not_modified = conditional_response(req, response, make_etag(await get_catalog_version(), category_name))
+    if not_modified:
+        return not_modified
+
     category = await engine.find_one(Category, Category.name == category_name)
     if not category:
         raise HTTPException(status_code=404, detail="Category not found")
     return category
 
-@router.get("/{category_name}/products", response_model=List[Product])
-async def list_category_products(category_name: str, req: Request):
-    user = req.state.user
+@router.get("/{category_name}/products", response_model=Page[Product])
+async def list_category_products(
+        category_name: str,
+        req: Request,
+        response: Response,
+        sort: ProductSort = ProductSort.NEWEST,
+        limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        cursor: Optional[str] = None,
+):
+    # Weak, stock and rating counts may lag behind the catalog version
+    etag = make_etag(
+        await get_catalog_version(), "admin" in req.state.user.roles, category_name, sort.value, limit, cursor,
+        weak=True,
+    )
+    not_modified = conditional_response(req, response, etag)
+    if not_modified:
+        return not_modified
+
     category = await engine.find_one(Category, Category.name == category_name)
     if not category:
         raise HTTPException(status_code=404, detail="Category not found")
 
-    return await engine.find(Product, Product.id.in_(category.product_ids) & (
-            Product.status == ProductStatus.PUBLISHED or user.role == "admin"
-    ))
+    return await find_product_page(
+        req, Product.category_names == category.name,
+        sort=sort, limit=limit, cursor=cursor
+    )
 
 
 # Update a category by ID
 @router.put("/{category_name}", status_code=204, dependencies=[Depends(role_admin)])
-async def update_category(category_name: str, category_data: Category):
-    category = await engine.find_one(Category, Category.name == category_name)
-    if not category:
+async def update_category(category_name: str, category_data: CategoryCreate):
+    try:
+        result = await engine.get_collection(Category).update_one(
+            {"name": category_name}, {"$set": {"name": category_data.name}}
+        )
+    except errors.DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Category already exists")
+    if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Category not found")
-    category_data.id = category.id
-    await engine.save(category_data)
+
+    if category_data.name != category_name:
+        # Rename membership on affected products only
+        now = datetime.datetime.now(datetime.UTC)
+        products = engine.get_collection(Product)
+        product_ids = await products.distinct("_id", {"category_names": category_name})
+        await products.bulk_write([
+            # Already in the new category, just leave the old one
+            UpdateMany({"category_names": {"$all": [category_name, category_data.name]}},
+                       {"$pull": {"category_names": category_name}, "$set": {"updated_at": now}}),
+            UpdateMany({"category_names": category_name},
+                       {"$set": {"category_names.$": category_data.name, "updated_at": now}}),
+        ])
+        await invalidate_products(*product_ids)
+
+    await bump_catalog_version()
 
 
 # Delete a category by ID
@@ -74,3 +121,12 @@ async def delete_category(category_name: str):
     if not category:
         raise HTTPException(status_code=404, detail="Category not found")
     await engine.delete(category)
+
+    products = engine.get_collection(Product)
+    product_ids = await products.distinct("_id", {"category_names": category_name})
+    await products.update_many(
+        {"category_names": category_name},
+        {"$pull": {"category_names": category_name}, "$set": {"updated_at": datetime.datetime.now(datetime.UTC)}}
+    )
+    await invalidate_products(*product_ids)
+    await bump_catalog_version()
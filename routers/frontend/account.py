@@ -2,9 +2,11 @@ from typing import Optional
 
 from fastapi import APIRouter, HTTPException, Request
 from pydantic import BaseModel, EmailStr
+from pymongo.errors import DuplicateKeyError
 
-from dependencies.oauth import pwd_context
-from globals import engine
+from dependencies.changes import ChangeTracker
+from dependencies.hashing import hash_password, verify_password
+from dependencies.oauth import invalidate_user
 from models import User
 
 router = APIRouter(prefix="/account", tags=["account"])
@@ -40,26 +42,35 @@ async def get_me(request: Request):
 @router.put("/password", status_code=204)
 async def update_password(pwd_req: UpdatePasswordRequest, request: Request):
     user = request.state.user
+    changes = ChangeTracker(user)
 
-    if not pwd_context.verify(pwd_req.old, user.password_hash):
+    if not await verify_password(pwd_req.old, user.password_hash):
         raise HTTPException(status_code=400, detail="Old password is incorrect")
 
-    user.password_hash = pwd_context.hash(pwd_req.new)
-    await engine.save(user)
+    user.password_hash = await hash_password(pwd_req.new)
+    await changes.save()
+    invalidate_user(user.id)
 
 
 @router.put("/email", status_code=204)
 async def update_email(request: UpdateEmailRequest, req: Request):
     user = req.state.user
+    changes = ChangeTracker(user)
 
     user.email = request.email
-    await engine.save(user)
+    try:
+        await changes.save()
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already in use")
+    invalidate_user(user.id)
 
 
 @router.put("/name", status_code=204)
 async def update_name(request: UpdateNameRequest, req: Request):
     user = req.state.user
+    changes = ChangeTracker(user)
 
     user.first_name = request.first
     user.last_name = request.last
-    await engine.save(user)
+    await changes.save()
+    invalidate_user(user.id)
@@ -4,6 +4,7 @@ from fastapi import APIRouter, HTTPException, Request
 from odmantic import ObjectId
 from pydantic import BaseModel
 
+from dependencies.changes import ChangeTracker
 from globals import engine, DEBUG
 from models import Address
 
@@ -22,7 +23,8 @@ async def create_address(address: AddressModel, req: Request):
     user = req.state.user
     new_address = Address(**address.model_dump())
     new_address.user = user
-    await engine.save(new_address)
+    # Plain insert, engine.save would cascade and write back the (cached) user too
+    await engine.get_collection(Address).insert_one(new_address.model_dump_doc())
 
 
 @router.get("", response_model=List[Address])
@@ -41,7 +43,7 @@ async def read_addresses(req: Request):
 @router.get("/{address_id}", response_model=Address)
 async def read_address(address_id: ObjectId, req: Request):
     user = req.state.user
-    address = await engine.find_one(Address, Address.id == address_id and Address.user == user.id)
+    address = await engine.find_one(Address, Address.id == address_id, Address.user == user.id)
     if address is None:
         raise HTTPException(status_code=404, detail="Address not found")
     del address.user
@@ -52,17 +54,18 @@ async def read_address(address_id: ObjectId, req: Request):
 @router.put("/{address_id}", status_code=204)
 async def update_address(address_id: ObjectId, address: AddressModel, req: Request):
     user = req.state.user
-    existing_address = await engine.find_one(Address, Address.id == address_id and Address.user == user.id)
+    existing_address = await engine.find_one(Address, Address.id == address_id, Address.user == user.id)
     if existing_address is None:
         raise HTTPException(status_code=404, detail="Address not found")
-    updated_address = existing_address.model_copy(update=address.model_dump())
-    await engine.save(updated_address)
+    changes = ChangeTracker(existing_address)
+    existing_address.model_update(address.model_dump())
+    await changes.save()
 
 
 @router.delete("/{address_id}", status_code=204)
 async def delete_address(address_id: ObjectId, req: Request):
     user = req.state.user
-    address = await engine.find_one(Address, Address.id == address_id and Address.user == user.id)
+    address = await engine.find_one(Address, Address.id == address_id, Address.user == user.id)
     if address is None:
         raise HTTPException(status_code=404, detail="Address not found")
     await engine.delete(address)
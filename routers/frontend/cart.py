@@ -4,8 +4,10 @@ from typing import List
 
 from fastapi import APIRouter, Request, Query, HTTPException
 from odmantic import ObjectId
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
+from dependencies.cart import apply_cart_changes, remove_cart_items
+from dependencies.pricing import price_cart
 from globals import engine
 from models import Cart, CartItem, Product, ProductStatus
 
@@ -22,6 +24,34 @@ class ItemBrief(CartItem):
     product: ProductInfo
 
 
+class CartChange(BaseModel):
+    product_id: ObjectId
+    # 0 removes the item
+    quantity: int = Field(ge=0, le=100)
+
+
+class BatchUpdateRequest(BaseModel):
+    items: List[CartChange] = Field(min_length=1, max_length=100)
+
+
+async def check_stock(changes: dict):
+    wanted = {product_id: qty for product_id, qty in changes.items() if qty > 0}
+    if not wanted:
+        return
+
+    products = engine.get_collection(Product).find(
+        {"_id": {"$in": list(wanted)}, "status": ProductStatus.PUBLISHED},
+        {"stock": 1},
+    )
+    stock = {product["_id"]: product["stock"] async for product in products}
+
+    if len(stock) != len(wanted):
+        raise HTTPException(status_code=404, detail="Product not found")
+
+    if any(stock[product_id] < qty for product_id, qty in wanted.items()):
+        raise HTTPException(status_code=400, detail="not enough stock")
+
+
 @router.get("", response_model=List[ItemBrief])
 async def read_cart(req: Request):
     user = req.state.user
@@ -29,67 +59,42 @@ async def read_cart(req: Request):
     if cart is None:
         return []
 
-    items = []
-    pending_remove = []
-    for item in cart.items:
-        product = await engine.find_one(Product, Product.id == item.product_id)
-        if product is None or product.status != ProductStatus.PUBLISHED or product.stock < item.quantity:
-            # Remove from cart
-            pending_remove.append(item.product_id)
-            continue
-        items.append(ItemBrief(
-            product_id=product.id,
-            quantity=item.quantity,
-            product=ProductInfo(
-                name=product.name, thumbnail_url=product.thumbnail_url, price=product.price
-            )))
+    pricing = await price_cart(cart.items)
 
-    if pending_remove:
-        cart.items = [item for item in cart.items if item.product_id not in pending_remove]
-        await engine.save(cart)
+    if pricing.invalid:
+        # Remove from cart
+        await remove_cart_items(cart.id, [item.product_id for item in pricing.invalid])
 
-    return items
+    return [ItemBrief(
+        product_id=line.product.id,
+        quantity=line.item.quantity,
+        product=ProductInfo(
+            name=line.product.name, thumbnail_url=line.product.thumbnail_url, price=line.unit_price
+        )) for line in pricing.items]
 
 
-@router.patch("/{product_id}", status_code=204)
-async def update_cart_qty(req: Request, product_id: ObjectId, qty: int = Query(ge=1, le=100)):
+@router.post("/batch", status_code=204)
+async def batch_update_cart(req: Request, request: BatchUpdateRequest):
     user = req.state.user
 
-    product = await engine.find_one(Product, Product.id == product_id and Product.status == ProductStatus.PUBLISHED)
-    if product is None:
-        raise HTTPException(status_code=404, detail="Product not found")
+    # Last change wins when a product is listed twice
+    changes = {change.product_id: change.quantity for change in request.items}
+    await check_stock(changes)
 
-    if product.stock < qty:
-        raise HTTPException(status_code=400, detail="not enough stock")
+    await apply_cart_changes(user.id, changes)
 
-    cart = await engine.find_one(Cart, Cart.user == user.id)
-    if cart is None:
-        cart = Cart(user=user)
 
-    for item in cart.items:
-        if item.product_id == product_id:
-            item.quantity = qty
-            await engine.save(cart)
-            return None
+@router.patch("/{product_id}", status_code=204)
+async def update_cart_qty(req: Request, product_id: ObjectId, qty: int = Query(ge=1, le=100)):
+    user = req.state.user
+
+    await check_stock({product_id: qty})
 
-    cart.items.append(CartItem(product_id=product_id, quantity=qty))
-    await engine.save(cart)
+    await apply_cart_changes(user.id, {product_id: qty})
 
 
 @router.delete("/{product_id}", status_code=204)
 async def delete_cart_item(req: Request, product_id: ObjectId):
     user = req.state.user
-    cart = await engine.find_one(Cart, Cart.user == user.id)
-    if cart is None:
-        return None
-
-    for idx, item in enumerate(cart.items):
-        if item.product_id == product_id:
-            del cart.items[idx]
-            await engine.save(cart)
-            break
-
-    if len(cart.items) == 0:
-        await engine.delete(cart)
 
-    return None
+    await apply_cart_changes(user.id, {product_id: 0})
@@ -1,3 +1,4 @@
+import datetime
 from decimal import Decimal
 from typing import List
 from uuid import uuid4
@@ -6,12 +7,18 @@ from fastapi import APIRouter, HTTPException, Request, Depends
 from fastapi.responses import HTMLResponse
 from odmantic import ObjectId
 from pydantic import BaseModel
+from pymongo.errors import DuplicateKeyError
 
+from dependencies.analytics import apply_order_rollup
+from dependencies.cart import remove_cart_items
+from dependencies.changes import ChangeTracker
 from dependencies.oauth import oauth_check_dep
+from dependencies.pricing import price_cart
+from dependencies.stock import reserve_stock, restock
 from dependencies.roles import role_customer
 from globals import engine
 from models import (Cart, CartItem, Payment, PaymentGateway, PaymentStatus, Order, OrderStatus, OrderItem,
-                    Address, Product, ProductStatus, User)
+                    Address, User)
 
 router = APIRouter(prefix="/checkout", tags=["checkout"])
 
@@ -41,37 +48,26 @@ async def cart_summary(req: Request):
     if not cart:
         raise HTTPException(status_code=404, detail="Cart not found")
 
-    total_amount = 0
-    items = []
-    pending_remove = []
-    for item in cart.items:
-        product = await engine.find_one(Product, Product.id == item.product_id)
-        if not product or product.status != ProductStatus.PUBLISHED or product.stock < item.quantity:
-            # Remove invalid product from cart
-            pending_remove.append(item)
-            continue
-
-        total_amount += product.price * item.quantity
-        items.append(ItemBrief(
-            product_id=product.id,
-            product=ProductInfo(
-                name=product.name,
-                thumbnail_url=product.thumbnail_url,
-                price=product.price
-            ),
-            quantity=item.quantity,
-            categories=product.category_names
-        ))
-
-    if pending_remove:
-        for item in pending_remove:
-            cart.items.remove(item)
-
-        await engine.save(cart)
+    pricing = await price_cart(cart.items)
+
+    if pricing.invalid:
+        # Remove invalid product from cart
+        await remove_cart_items(cart.id, [item.product_id for item in pricing.invalid])
+
+    items = [ItemBrief(
+        product_id=line.product.id,
+        product=ProductInfo(
+            name=line.product.name,
+            thumbnail_url=line.product.thumbnail_url,
+            price=line.unit_price
+        ),
+        quantity=line.item.quantity,
+        categories=line.product.category_names
+    ) for line in pricing.items]
 
     return SummaryResponse(
         cart_id=cart.id,
-        amount=total_amount,
+        amount=pricing.total,
         total_items=len(items),
         items=items
     )
@@ -85,10 +81,8 @@ async def payment_options(req: Request):
     if not cart:
         raise HTTPException(status_code=404, detail="Cart not found")
 
-    products = await engine.find(Product, Product.id.in_([item.product_id for item in cart.items]))
-
-    total_amount = sum([product.price * item.quantity for product, item in zip(products, cart.items)])
-    if total_amount == Decimal('0.00'):
+    pricing = await price_cart(cart.items)
+    if pricing.total == Decimal('0.00'):
         return [PaymentGateway.FREE]
     else:
         return [PaymentGateway.DUMMY_GATEWAY]
@@ -114,30 +108,36 @@ async def create_payment(
         if not address:
             raise HTTPException(status_code=404, detail="Address not found")
 
-        order_items = []
-        total_amount = 0
-
-        products = await engine.find(Product, Product.id.in_([item.product_id for item in cart.items]))
-
-        for item in cart.items:
-            product = next((p for p in products if p.id == item.product_id), None)
-            if not product:
-                continue
-
-            if product.status != ProductStatus.PUBLISHED or product.stock < item.quantity:
-                raise HTTPException(status_code=400, detail=f"One (or more) product is not available from cart")
-
-            total_amount += product.price * item.quantity
-            order_items.append(OrderItem(product_id=item.product_id, quantity=item.quantity))
+        pricing = await price_cart(cart.items)
+        lines = {line.item.product_id: line.item.quantity for line in pricing.items}
+        if pricing.invalid or not await reserve_stock(lines):
+            raise HTTPException(status_code=400, detail=f"One (or more) product is not available from cart")
 
         order = Order(
             id=cart_id,
             user=user,
             address=address,
-            items=order_items,
-            total_amount=total_amount,
+            items=[
+                OrderItem(
+                    product_id=line.item.product_id,
+                    quantity=line.item.quantity,
+                    price=float(line.unit_price),
+                    category_names=line.product.category_names,
+                )
+                for line in pricing.items
+            ],
+            total_amount=float(pricing.total),
+            stock_reserved=True,
         )
-        await engine.save(order)
+        try:
+            # Plain insert, a concurrent pay on the same cart fails here instead of overwriting the order
+            await engine.get_collection(Order).insert_one(order.model_dump_doc())
+        except DuplicateKeyError:
+            await restock(lines)
+            raise HTTPException(status_code=400, detail="Order already processed")
+        except Exception:
+            await restock(lines)
+            raise
 
         # delete cart
         await engine.delete(cart)
@@ -147,6 +147,8 @@ async def create_payment(
         # old joke, let's see how many people get it instead of Googling it
         raise HTTPException(status_code=400, detail="Ah ah ah, you didn't say the magic word")
 
+    changes = ChangeTracker(order)
+
     # Get latest payment status from order
     if order.payments:
         last_payment = order.payments[-1]
@@ -154,7 +156,6 @@ async def create_payment(
             # Cancel the previous payment
             last_payment.status = PaymentStatus.CANCELLED
             # Feature: Cancel payment based on gateway
-            await engine.save(last_payment)
 
     payment = Payment(
         amount=order.total_amount,
@@ -164,7 +165,17 @@ async def create_payment(
 
     # Add payment ID to order
     order.payments.append(payment)
-    await engine.save(order)
+
+    if gateway == PaymentGateway.FREE:
+        # No payment required, update order status now.
+        payment.status = PaymentStatus.PAID
+        order.expire_date = None  # Feature: Clear cron task
+        order.status = OrderStatus.PROCESSING
+        order.paid_at = datetime.datetime.now(datetime.UTC)
+
+    # Written once, guarded against a concurrent callback or cancellation
+    if not await changes.save({"status": OrderStatus.PENDING_PAYMENT}):
+        raise HTTPException(status_code=400, detail="Order already processed")
 
     params = f"order_id={order.id}"
     params += f"&user_id={user.id}"
@@ -172,11 +183,7 @@ async def create_payment(
     # Redirect based on payment gateway
     match gateway:
         case PaymentGateway.FREE:
-            # No payment required, update order status now.
-            payment.status = PaymentStatus.PAID
-            order.expire_date = None  # Feature: Clear cron task
-            order.status = OrderStatus.PROCESSING
-            await engine.save(order)
+            await apply_order_rollup(order.id)
             return {"redirect_url": f"/api/order/{cart_id}"}
         case PaymentGateway.DUMMY_GATEWAY:
             return {"redirect_url": f"/api/checkout/dummy-payment?{params}"}
@@ -246,14 +253,20 @@ async def payment_callback(
         raise HTTPException(status_code=404, detail="Order not found")
 
     # Feature: Do gateway verify
+    changes = ChangeTracker(order)
 
     if payment_status == PaymentStatus.PAID:
         order.expire_date = None  # Feature: Clear cron task
         order.status = OrderStatus.PROCESSING
+        order.paid_at = datetime.datetime.now(datetime.UTC)
 
     last_payment = order.payments[-1]
     last_payment.status = PaymentStatus.FAILED if payment_status != PaymentStatus.PAID else PaymentStatus.PAID
     last_payment.reference_id = reference_id
-    await engine.save(order)
+    if not await changes.save({"status": OrderStatus.PENDING_PAYMENT}):
+        raise HTTPException(status_code=404, detail="Order not found")
+
+    if order.status == OrderStatus.PROCESSING:
+        await apply_order_rollup(order.id)
 
     raise HTTPException(status_code=302, headers={"Location": "/orders"})
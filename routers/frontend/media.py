@@ -1,22 +1,41 @@
+import asyncio
+import base64
+import mimetypes
 import os
 from hashlib import md5
+from typing import List, Optional, Tuple
 from uuid import UUID
 
 # noinspection PyPackageRequirements
 from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
 # noinspection PyPackageRequirements
-from azure.storage.blob import BlobServiceClient
-from fastapi import APIRouter, UploadFile, File, HTTPException, Depends
-from fastapi.responses import StreamingResponse
+from azure.storage.blob import ContentSettings
+# noinspection PyPackageRequirements
+from azure.storage.blob.aio import BlobServiceClient, BlobClient
+from fastapi import APIRouter, UploadFile, HTTPException, Depends, Request, Response
+from fastapi.responses import StreamingResponse, FileResponse
 from pydantic import BaseModel
 
+from dependencies.media_cache import media_cache, CachedMedia
 from dependencies.oauth import oauth_check_dep
 from dependencies.roles import role_admin
-from globals import BLOB_CONTAINER_NAME, BLOB_CONNECTION_STRING
+from globals import (BLOB_CONTAINER_NAME, BLOB_CONNECTION_STRING, MEDIA_MAX_UPLOAD_BYTES, MEDIA_CHUNK_SIZE,
+                     MEDIA_UPLOAD_CONCURRENCY)
 
 router = APIRouter(prefix="/media", tags=["media"])
 
-# Initialize the BlobServiceClient
+# Boundaries and part headers on top of the file itself, the file size is checked exactly in hash_upload
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+UPLOAD_BODY = {
+    "required": True,
+    "content": {"multipart/form-data": {"schema": {
+        "type": "object",
+        "properties": {"file": {"type": "string", "format": "binary"}},
+        "required": ["file"],
+    }}},
+}
+
+# Initialize the BlobServiceClient, async so blob I/O never blocks the event loop
 blob_service_client = BlobServiceClient.from_connection_string(BLOB_CONNECTION_STRING)
 
 
@@ -30,19 +49,105 @@ class UploadResponse(BaseModel):
     url: str
 
 
-@router.post("/upload", response_model=UploadResponse, dependencies=[Depends(oauth_check_dep), Depends(role_admin)])
-async def upload_image(file: UploadFile = File(...)):
+def limit_body(req: Request, limit: int) -> Request:
+    """The same request with a body that fails with 413 once past limit bytes, checked as it is received"""
+    length = req.headers.get("content-length")
+    if length and length.isdigit() and int(length) > limit:
+        raise HTTPException(status_code=413, detail="File too large")
+
+    received = 0
+
+    async def receive():
+        nonlocal received
+        message = await req.receive()
+        if message["type"] == "http.request":
+            received += len(message.get("body", b""))
+            # Content-Length can be missing (chunked) or lie, count what actually arrives
+            if received > limit:
+                raise HTTPException(status_code=413, detail="File too large")
+        return message
+
+    return Request(req.scope, receive)
+
+
+async def hash_upload(file: UploadFile) -> str:
+    if file.size is not None and file.size > MEDIA_MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="File too large")
+
+    # Chunk by chunk from the spooled upload, never the whole file in memory
+    file_md5, size = md5(), 0
+    await file.seek(0)
+    while chunk := await file.read(MEDIA_CHUNK_SIZE):
+        size += len(chunk)
+        if size > MEDIA_MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="File too large")
+        file_md5.update(chunk)
+    return file_md5.hexdigest()
+
+
+async def upload_blocks(blob_client: BlobClient, file: UploadFile):
+    # Stage fixed-size blocks in parallel, the semaphore bounds in-flight (and in-memory) chunks
+    semaphore = asyncio.Semaphore(MEDIA_UPLOAD_CONCURRENCY)
+    block_ids, tasks = [], []
+
+    async def stage(block_id: str, chunk: bytes):
+        try:
+            await blob_client.stage_block(block_id, chunk)
+        finally:
+            semaphore.release()
+
+    await file.seek(0)
+    try:
+        while True:
+            await semaphore.acquire()
+            chunk = await file.read(MEDIA_CHUNK_SIZE)
+            if not chunk:
+                semaphore.release()
+                break
+            # Block ids must all have the same length
+            block_id = base64.b64encode(f"{len(block_ids):08d}".encode()).decode()
+            block_ids.append(block_id)
+            tasks.append(asyncio.create_task(stage(block_id, chunk)))
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    await blob_client.commit_block_list(
+        block_ids, content_settings=ContentSettings(content_type=file.content_type or "application/octet-stream")
+    )
+
+
+# The form is parsed here rather than with File(...), FastAPI would spool the whole body before any check
+@router.post(
+    "/upload", response_model=UploadResponse, openapi_extra={"requestBody": UPLOAD_BODY},
+    dependencies=[Depends(oauth_check_dep), Depends(role_admin)],
+)
+async def upload_image(req: Request):
+    form = await limit_body(req, MEDIA_MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES).form(max_files=1)
+    try:
+        file = form.get("file")
+        # A plain field comes back as str
+        if file is None or isinstance(file, str):
+            raise HTTPException(status_code=422, detail="file is required")
+        return await store_upload(file)
+    finally:
+        await form.close()
+
+
+async def store_upload(file: UploadFile) -> UploadResponse:
     file_ext = get_file_extension(file.filename)
 
     # Get file md5
-    file.file.seek(0)
-    file_md5 = md5(file.file.read()).hexdigest()
-    file.file.seek(0)
+    file_md5 = await hash_upload(file)
 
     file_name = f"{UUID(file_md5)}{file_ext}"
     try:
         blob_client = blob_service_client.get_blob_client(container=BLOB_CONTAINER_NAME, blob=file_name)
-        blob_client.upload_blob(file.file)
+        # Content addressed, the same file is only stored once
+        if not await blob_client.exists():
+            await upload_blocks(blob_client, file)
         return UploadResponse(filename=file_name, url=f"/api/media/{file_name}")
     except ResourceExistsError:
         return UploadResponse(filename=file_name, url=f"/api/media/{file_name}")
@@ -50,22 +155,145 @@ async def upload_image(file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail="Failed to upload image")
 
 
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Single "bytes=" range as inclusive (start, end), None serves the whole file"""
+    if not header or not header.startswith("bytes=") or "," in header:
+        # Multiple ranges aren't supported, a full response is a valid answer to them
+        return None
+
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            # Suffix range, the last N bytes
+            start, end = max(size - int(last), 0), size - 1
+    except ValueError:
+        return None
+
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+def requested_range(req: Request, size: int, etag: str) -> Optional[Tuple[int, int]]:
+    """The range to serve, the same for every tier (memory, disk, blob storage)"""
+    if not size:
+        return None
+    # If-Range only ever matches our ETag, the content behind a name never changes
+    if_range = req.headers.get("if-range")
+    if if_range is not None and if_range != etag:
+        return None
+    return parse_range(req.headers.get("range"), size)
+
+
+class RangeFileResponse(FileResponse):
+    """FileResponse serving a range already picked by requested_range instead of parsing its own"""
+
+    def __init__(self, path: str, byte_range: Optional[Tuple[int, int]], **kwargs):
+        super().__init__(path, **kwargs)
+        self.byte_range = byte_range
+
+    def _parse_range_header(self, http_range: str, file_size: int) -> List[Tuple[int, int]]:
+        # Only consulted when a Range header is present, an empty list sends the whole file
+        if self.byte_range is None:
+            return []
+        # FileResponse ranges are end-exclusive
+        return [(self.byte_range[0], self.byte_range[1] + 1)]
+
+
 @router.get("/{filename}", response_class=StreamingResponse)
-async def download_image(filename: str):
+@router.head("/{filename}", response_class=StreamingResponse)
+async def download_image(filename: str, req: Request):
     try:
-        file_name, _ = filename.rsplit(".", 1)
-        if not UUID(file_name, version=4):
-            raise HTTPException(status_code=400, detail="Invalid filename")
+        file_name, file_ext = filename.rsplit(".", 1)
+        UUID(file_name)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid filename")
 
+    # Content addressed (md5 of the file), a name always maps to the same bytes
+    headers = {
+        "ETag": f'"{file_name}"',
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f"attachment; filename={filename}",
+    }
+    if headers["ETag"] in req.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+
+    cached = await media_cache.get(filename)
+    if cached is None:
         blob_client = blob_service_client.get_blob_client(container=BLOB_CONTAINER_NAME, blob=filename)
-        stream = blob_client.download_blob().readall()
-        return StreamingResponse(iter([stream]), media_type="image/jpeg", headers={
-            "Content-Disposition": f"attachment; filename={filename}",
-            "Cache-Control": "public, max-age=3600",
-            "Pragma": "public",
-            "Expires": "3600"
-        })
-    except ResourceNotFoundError:
-        raise HTTPException(status_code=404)
-    except Exception:
-        raise HTTPException(status_code=500, detail="Failed to download image")
+        try:
+            properties = await blob_client.get_blob_properties()
+        except ResourceNotFoundError:
+            raise HTTPException(status_code=404)
+        except Exception:
+            raise HTTPException(status_code=500, detail="Failed to download image")
+
+        content_type = properties.content_settings.content_type
+        if not content_type or content_type == "application/octet-stream":
+            # Uploaded before content types were stored
+            content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+        # HEAD doesn't need the bytes, no point filling the cache for it
+        if req.method == "HEAD" or not media_cache.cacheable(properties.size):
+            return stream_blob(blob_client, req, properties.size, content_type, headers)
+
+        async def fetch():
+            return (await blob_client.download_blob()).chunks()
+
+        try:
+            cached = await media_cache.fill(filename, content_type, fetch)
+        except Exception:
+            raise HTTPException(status_code=500, detail="Failed to download image")
+
+    return serve_cached(cached, req, headers)
+
+
+def stream_blob(blob_client: BlobClient, req: Request, size: int, content_type: str, headers: dict) -> Response:
+    # Too large for the media cache, straight from blob storage
+    status_code, offset, length = 200, 0, size
+    byte_range = requested_range(req, size, headers["ETag"])
+    if byte_range:
+        status_code, offset, length = 206, byte_range[0], byte_range[1] - byte_range[0] + 1
+        headers["Content-Range"] = f"bytes {byte_range[0]}-{byte_range[1]}/{size}"
+
+    headers["Content-Length"] = str(length)
+
+    if req.method == "HEAD" or not length:
+        return Response(status_code=status_code, headers=headers, media_type=content_type)
+
+    async def iterate():
+        downloader = await blob_client.download_blob(offset=offset, length=length)
+        async for chunk in downloader.chunks():
+            yield chunk
+
+    return StreamingResponse(iterate(), status_code=status_code, headers=headers, media_type=content_type)
+
+
+def serve_cached(cached: CachedMedia, req: Request, headers: dict) -> Response:
+    byte_range = requested_range(req, cached.size, headers["ETag"])
+    if req.method != "HEAD":
+        media_cache.served(byte_range[1] - byte_range[0] + 1 if byte_range else cached.size)
+
+    if cached.data is None:
+        # HEAD and zero-copy sending (pathsend / sendfile) are handled by FileResponse
+        return RangeFileResponse(
+            cached.path, byte_range, stat_result=cached.stat, headers=headers, media_type=cached.content_type
+        )
+
+    if byte_range:
+        body = cached.data[byte_range[0]:byte_range[1] + 1]
+        headers["Content-Range"] = f"bytes {byte_range[0]}-{byte_range[1]}/{cached.size}"
+    else:
+        body = cached.data
+    headers["Content-Length"] = str(len(body))
+
+    return Response(
+        b"" if req.method == "HEAD" else body,
+        status_code=206 if byte_range else 200,
+        headers=headers,
+        media_type=cached.content_type,
+    )
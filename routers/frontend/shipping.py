@@ -1,10 +1,14 @@
-from typing import Optional
+from typing import List, Optional
 
 from fastapi import APIRouter, HTTPException, Request, Depends
 from odmantic import ObjectId
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
+from dependencies.analytics import reverse_order_rollup
+from dependencies.bulk_orders import BulkOrderReport, BulkOrderResult, MAX_BULK_ORDERS, release_cancelled_orders
+from dependencies.changes import ChangeTracker
 from dependencies.roles import role_admin
+from dependencies.stock import release_order_stock
 from globals import engine
 from models import Order, Shipping, ShippingStatus, User, ShippingCarrier, OrderStatus
 
@@ -20,6 +24,40 @@ class StatusUpdateRequest(BaseModel):
     status: ShippingStatus
 
 
+class BulkCarrierRequest(CarrierUpdateRequest):
+    order_ids: List[ObjectId] = Field(min_length=1, max_length=MAX_BULK_ORDERS)
+
+
+class TrackingUpdate(BaseModel):
+    order_id: ObjectId
+    tracking_number: str
+
+
+class BulkTrackingRequest(BaseModel):
+    items: List[TrackingUpdate] = Field(min_length=1, max_length=MAX_BULK_ORDERS)
+
+
+class BulkStatusRequest(StatusUpdateRequest):
+    order_ids: List[ObjectId] = Field(min_length=1, max_length=MAX_BULK_ORDERS)
+
+
+def order_status_for(status: ShippingStatus) -> Optional[OrderStatus]:
+    # Order status following a shipping status change, None leaves it as is
+    match status:
+        case ShippingStatus.SHIPPED:
+            return OrderStatus.DELIVERING
+        case ShippingStatus.DELIVERED:
+            return OrderStatus.COMPLETED
+        case ShippingStatus.CANCELLED:
+            return OrderStatus.CANCELLED
+    return None
+
+
+def order_status_allows(current: OrderStatus, target: Optional[OrderStatus]) -> bool:
+    # The order may already be in the target status when it was set by hand, it never moves backwards
+    return target is None or target == current or current.can_transition_to(target)
+
+
 async def get_shipping_by_order(order_id: ObjectId, user: Optional[User] = None):
     if user:
         order = await engine.find_one(Order, Order.id == order_id, Order.user == user.id)
@@ -32,6 +70,62 @@ async def get_shipping_by_order(order_id: ObjectId, user: Optional[User] = None)
     return order, order.shipping
 
 
+# Bulk updates, must be declared before /{order_id}
+@router.patch("/bulk/carrier", response_model=List[BulkOrderResult], dependencies=[Depends(role_admin)])
+async def bulk_update_shipping_carrier(request: BulkCarrierRequest):
+    report = BulkOrderReport(request.order_ids)
+
+    update = {"shipping.shipping_carrier": request.shipping_carrier}
+    if request.tracking_number is not None:
+        update["shipping.tracking_number"] = request.tracking_number
+    for order_id in await report.load({"_id": 1}):
+        report.update(order_id, {}, {"$set": update})
+
+    await report.apply(update)
+    return report.report()
+
+
+@router.patch("/bulk/tracking", response_model=List[BulkOrderResult], dependencies=[Depends(role_admin)])
+async def bulk_update_shipping_tracking(request: BulkTrackingRequest):
+    # Last entry wins when an order is listed twice
+    tracking = {item.order_id: item.tracking_number for item in request.items}
+    report = BulkOrderReport(list(tracking))
+
+    for order_id in await report.load({"_id": 1}):
+        report.update(order_id, {}, {"$set": {"shipping.tracking_number": tracking[order_id]}})
+
+    # Unguarded updates only miss orders deleted in the meantime
+    await report.apply({})
+    return report.report()
+
+
+@router.patch("/bulk/status", response_model=List[BulkOrderResult], dependencies=[Depends(role_admin)])
+async def bulk_update_shipping_status(request: BulkStatusRequest):
+    report = BulkOrderReport(request.order_ids)
+
+    update = {"shipping.status": request.status}
+    order_status = order_status_for(request.status)
+    if order_status:
+        update["status"] = order_status
+
+    for order_id, order in (await report.load({"shipping.status": 1, "status": 1})).items():
+        current = ShippingStatus(order["shipping"]["status"])
+        if not current.can_transition_to(request.status):
+            report.fail(order_id, "Invalid status transition")
+            continue
+        if not order_status_allows(OrderStatus(order["status"]), order_status):
+            report.fail(order_id, "Invalid order status transition")
+            continue
+        report.update(order_id, {"shipping.status": current, "status": order["status"]}, {"$set": update})
+
+    applied = await report.apply({"shipping.status": request.status})
+
+    if order_status == OrderStatus.CANCELLED:
+        await release_cancelled_orders(applied)
+
+    return report.report()
+
+
 @router.get("/{order_id}", response_model=Shipping)
 async def get_shipping(req: Request, order_id: ObjectId):
     user = req.state.user
@@ -43,34 +137,37 @@ async def get_shipping(req: Request, order_id: ObjectId):
 @router.patch("/{order_id}/carrier", status_code=204, dependencies=[Depends(role_admin)])
 async def update_shipping_carrier(order_id: ObjectId, req: CarrierUpdateRequest):
     order, shipping = await get_shipping_by_order(order_id)
+    changes = ChangeTracker(order)
 
     shipping.model_update(req)
-    await engine.save(order)
+    await changes.save()
 
 
 @router.patch("/{order_id}/tracking", status_code=204, dependencies=[Depends(role_admin)])
 async def update_shipping_tracking(order_id: ObjectId, tracking_number: str):
     order, shipping = await get_shipping_by_order(order_id)
+    changes = ChangeTracker(order)
 
     shipping.tracking_number = tracking_number
-    await engine.save(order)
+    await changes.save()
 
 
 @router.patch("/{order_id}/status", status_code=204, dependencies=[Depends(role_admin)])
 async def update_shipping_status(order_id: ObjectId, req: StatusUpdateRequest):
     order, shipping = await get_shipping_by_order(order_id)
+    changes = ChangeTracker(order)
 
     if not shipping.status.can_transition_to(req.status):
         raise HTTPException(status_code=400, detail="Invalid status transition")
+    order_status = order_status_for(req.status)
+    if not order_status_allows(order.status, order_status):
+        raise HTTPException(status_code=400, detail="Invalid order status transition")
 
     shipping.status = req.status
+    order.status = order_status or order.status
 
-    match shipping.status:
-        case ShippingStatus.SHIPPED:
-            order.status = OrderStatus.DELIVERING
-        case ShippingStatus.DELIVERED:
-            order.status = OrderStatus.COMPLETED
-        case ShippingStatus.CANCELLED:
-            order.status = OrderStatus.CANCELLED
+    await changes.save()
 
-    await engine.save(order)
+    if order.status == OrderStatus.CANCELLED:
+        await release_order_stock(order.id)
+        await reverse_order_rollup(order.id)
@@ -0,0 +1,10 @@
+from fastapi import APIRouter
+
+from dependencies import metrics
+
+router = APIRouter(prefix="/metrics", tags=["metrics"])
+
+
+@router.get("", response_model=dict)
+async def read_metrics():
+    return metrics.snapshot()
@@ -1,14 +1,37 @@
-from typing import List
+import datetime
+from typing import List, Optional
 
-from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi import APIRouter, HTTPException, Depends, Request, Query
 from odmantic import ObjectId
+from pydantic import BaseModel, Field
 
+from dependencies.analytics import reverse_order_rollup, reverse_deleted_order
+from dependencies.bulk_orders import BulkOrderReport, BulkOrderResult, MAX_BULK_ORDERS, release_cancelled_orders
+from dependencies.changes import ChangeTracker
+from dependencies.pagination import Page, encode_cursor, decode_cursor, keyset_query, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
 from dependencies.roles import role_admin
+from dependencies.stock import release_order_stock, restock
+from dependencies.streaming import wants_ndjson, ndjson_response
 from globals import engine
 from models import Order, OrderStatus
 
 router = APIRouter(prefix="/order", tags=["order"])
 
+SUMMARY_SORT = "newest"
+
+
+class OrderSummary(BaseModel):
+    id: ObjectId
+    status: OrderStatus
+    total_amount: float
+    item_count: int
+    created_at: datetime.datetime
+
+
+class BulkStatusRequest(BaseModel):
+    order_ids: List[ObjectId] = Field(min_length=1, max_length=MAX_BULK_ORDERS)
+    status: OrderStatus
+
 
 # Read all orders
 @router.get("/me", response_model=List[Order])
@@ -23,8 +46,48 @@ async def read_my_orders(req: Request):
     return orders
 
 
+# Order history without references, read_order is the drill-down
+@router.get("/me/summary", response_model=Page[OrderSummary])
+async def read_my_order_summaries(
+        req: Request,
+        status: Optional[List[OrderStatus]] = Query(default=None),
+        limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        cursor: Optional[str] = None,
+):
+    user = req.state.user
+
+    # Always an $in on status, so (user, status, created_at) serves the sort for any filter by merging status ranges
+    match = {"user": user.id, "status": {"$in": list(status or OrderStatus)}}
+    if cursor:
+        created_at, last_id = decode_cursor(cursor, SUMMARY_SORT)
+        match.update(keyset_query("created_at", created_at, last_id, descending=True))
+
+    docs = await engine.get_collection(Order).aggregate([
+        {"$match": match},
+        {"$sort": {"created_at": -1, "_id": -1}},
+        # One extra document to know whether there is a next page
+        {"$limit": limit + 1},
+        {"$project": {
+            "status": 1,
+            "total_amount": 1,
+            "item_count": {"$size": "$items"},
+            "created_at": 1,
+        }},
+    ]).to_list(length=None)
+
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = encode_cursor(SUMMARY_SORT, docs[-1]["created_at"], docs[-1]["_id"])
+
+    return Page(items=[OrderSummary(id=doc.pop("_id"), **doc) for doc in docs], next_cursor=next_cursor)
+
+
 @router.get("/all", response_model=List[Order], dependencies=[Depends(role_admin)])
-async def read_all_orders():
+async def read_all_orders(req: Request):
+    if wants_ndjson(req):
+        return ndjson_response(Order)
+
     orders = await engine.find(Order)
 
     for order in orders:
@@ -38,10 +101,10 @@ async def read_all_orders():
 @router.get("/{order_id}", response_model=Order)
 async def read_order(order_id: ObjectId, req: Request):
     user = req.state.user
-    order = await engine.find_one(
-        Order,
-        Order.id == order_id and (Order.user == user.id or user.role == "admin")
-    )
+    queries = [Order.id == order_id]
+    if "admin" not in user.roles:
+        queries.append(Order.user == user.id)
+    order = await engine.find_one(Order, *queries)
 
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
@@ -51,6 +114,25 @@ async def read_order(order_id: ObjectId, req: Request):
     return order
 
 
+# Bulk status change, must be declared before /{order_id}
+@router.patch("/bulk/status", response_model=List[BulkOrderResult], dependencies=[Depends(role_admin)])
+async def bulk_update_order_status(request: BulkStatusRequest):
+    report = BulkOrderReport(request.order_ids)
+
+    for order_id, order in (await report.load({"status": 1})).items():
+        if not OrderStatus(order["status"]).can_transition_to(request.status):
+            report.fail(order_id, "Invalid status transition")
+            continue
+        report.update(order_id, {"status": order["status"]}, {"$set": {"status": request.status}})
+
+    applied = await report.apply({"status": request.status})
+
+    if request.status == OrderStatus.CANCELLED:
+        await release_cancelled_orders(applied)
+
+    return report.report()
+
+
 # Update an order by ID
 @router.patch("/{order_id}/status", status_code=204, dependencies=[Depends(role_admin)])
 async def update_order(order_id: ObjectId, order_status: OrderStatus):
@@ -58,18 +140,29 @@ async def update_order(order_id: ObjectId, order_status: OrderStatus):
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
 
-    if not order_status.can_transition_to(order.status):
+    if not order.status.can_transition_to(order_status):
         raise HTTPException(status_code=400, detail="Invalid status transition")
 
+    changes = ChangeTracker(order)
+    previous_status = order.status
     order.status = order_status
-    await engine.save(order)
+    if not await changes.save({"status": previous_status}):
+        raise HTTPException(status_code=400, detail="Order changed concurrently")
+
+    if order_status == OrderStatus.CANCELLED:
+        await release_order_stock(order.id)
+        await reverse_order_rollup(order.id)
 
 
 # Delete an order by ID
 @router.delete("/{order_id}", status_code=204, dependencies=[Depends(role_admin)])
 async def delete_order(order_id: ObjectId):
-    order = await engine.find_one(Order, Order.id == order_id)
+    order = await engine.get_collection(Order).find_one_and_delete({"_id": order_id})
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
 
-    await engine.delete(order)
+    # Unpaid orders still hold their items
+    if order.get("stock_reserved") and order["status"] == OrderStatus.PENDING_PAYMENT:
+        await restock({item["product_id"]: item["quantity"] for item in order["items"]})
+
+    await reverse_deleted_order(order)
@@ -1,18 +1,70 @@
+import datetime
 from decimal import Decimal
+from enum import Enum
 from typing import List, Optional
 
-from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi import APIRouter, HTTPException, Depends, Request, Query, Response, UploadFile, File
+from fastapi.responses import StreamingResponse
 from odmantic import ObjectId
 from odmantic.exceptions import DuplicateKeyError
 from pydantic import BaseModel
-
+from pymongo import errors
+
+from dependencies.catalog_io import CatalogFormat, detect_format, import_products, export_products
+from dependencies.categories import ensure_categories
+from dependencies.changes import ChangeTracker
+from dependencies.facets import BrowsePage, browse_products
+from dependencies.etag import (make_etag, conditional_response, get_catalog_version, bump_catalog_version,
+                               product_version)
+from dependencies.product_cache import get_product, invalidate_products
+from dependencies.pagination import Page, find_page, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
 from dependencies.roles import role_admin
+from dependencies.search import strip_html, search_products
+from dependencies.streaming import wants_ndjson, ndjson_response, NDJSON_MEDIA_TYPE
 from globals import engine
-from models import Product, Category, Review, ProductStatus
+from models import Product, Review, ProductStatus
 
 router = APIRouter(prefix="/products", tags=["products"])
 
 
+class ProductSort(str, Enum):
+    NEWEST = "newest"
+    OLDEST = "oldest"
+    PRICE_ASC = "price_asc"
+    PRICE_DESC = "price_desc"
+    NAME_ASC = "name_asc"
+    NAME_DESC = "name_desc"
+
+    __keys__ = {
+        # sort: (key, descending), key None means created order (_id)
+        NEWEST: (None, True),
+        OLDEST: (None, False),
+        PRICE_ASC: ("price", False),
+        PRICE_DESC: ("price", True),
+        NAME_ASC: ("name", False),
+        NAME_DESC: ("name", True),
+    }
+
+    @property
+    def key(self):
+        return self.__keys__[self][0]  # noqa
+
+    @property
+    def descending(self):
+        return self.__keys__[self][1]  # noqa
+
+
+async def find_product_page(req: Request, *queries, sort: ProductSort, limit: int, cursor: Optional[str]):
+    if "admin" not in req.state.user.roles:
+        queries += (Product.status == ProductStatus.PUBLISHED,)
+
+    return await find_page(
+        Product, *queries,
+        sort=sort.value, key=sort.key, descending=sort.descending,
+        limit=limit, cursor=cursor
+    )
+
+
 class UpdateProductRequest(BaseModel):
     sku: Optional[str] = None
     name: Optional[str] = None
@@ -33,42 +85,127 @@ class UpdateProductRequest(BaseModel):
 # Create a new product
 @router.post("", response_model=Product, status_code=201, dependencies=[Depends(role_admin)])
 async def create_product(product: Product):
+    # Derived, whatever the body sent for it is replaced
+    product.description_text = strip_html(product.description_html)
+    product.updated_at = datetime.datetime.now(datetime.UTC)
     try:
         await engine.save(product)
     except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Product already exists")
 
-    # Update category
-    for name in product.category_names:
-        category = await engine.find_one(Category, Category.name == name)
-        if not category:
-            # Create if not exist
-            category = Category(name=name)
-            await engine.save(category)
-
-        category.product_ids.append(product.id)
-        await engine.save(category)
+    await ensure_categories(product.category_names)
+    await bump_catalog_version()
 
     return product
 
 
+# Bulk upsert by sku from CSV or NDJSON, must be declared before /{product_id}
+@router.post("/import", response_class=StreamingResponse, dependencies=[Depends(role_admin)])
+async def import_catalog(
+        file: UploadFile = File(...),
+        fmt: Optional[CatalogFormat] = Query(default=None, alias="format"),
+):
+    # Progress and per-row errors are streamed back as NDJSON while the upload is processed
+    return StreamingResponse(import_products(file, fmt or detect_format(file)), media_type=NDJSON_MEDIA_TYPE)
+
+
+# Export in the format /import reads, must be declared before /{product_id}
+@router.get("/export", response_class=StreamingResponse, dependencies=[Depends(role_admin)])
+async def export_catalog(fmt: CatalogFormat = Query(default=CatalogFormat.NDJSON, alias="format")):
+    return export_products(fmt)
+
+
+# Search products, must be declared before /{product_id}
+@router.get("/search", response_model=Page[Product])
+async def search(
+        req: Request,
+        q: str = Query(min_length=1, max_length=200),
+        status: Optional[ProductStatus] = None,
+        limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        cursor: Optional[str] = None,
+):
+    # Customers only ever see published products
+    if "admin" not in req.state.user.roles:
+        status = ProductStatus.PUBLISHED
+
+    return await search_products(q, status, limit, cursor)
+
+
+# Filtered listing with facet counts, must be declared before /{product_id}
+@router.get("/browse", response_model=BrowsePage)
+async def browse(
+        req: Request,
+        category: Optional[List[str]] = Query(default=None),
+        tags: Optional[List[str]] = Query(default=None),
+        min_price: Optional[float] = Query(default=None, ge=0),
+        max_price: Optional[float] = Query(default=None, ge=0),
+        min_rating: Optional[int] = Query(default=None, ge=1, le=5),
+        in_stock: bool = False,
+        sort: ProductSort = ProductSort.NEWEST,
+        limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        cursor: Optional[str] = None,
+):
+    match = {}
+    if "admin" not in req.state.user.roles:
+        match["status"] = ProductStatus.PUBLISHED
+    if category:
+        match["category_names"] = {"$in": category}
+    if tags:
+        match["tags"] = {"$all": tags}
+    if min_price is not None or max_price is not None:
+        match["price"] = {}
+        if min_price is not None:
+            match["price"]["$gte"] = min_price
+        if max_price is not None:
+            match["price"]["$lte"] = max_price
+    if min_rating is not None:
+        match["rating.average"] = {"$gte": min_rating}
+    if in_stock:
+        match["stock"] = {"$gt": 0}
+
+    return await browse_products(
+        match,
+        sort=sort.value, key=sort.key, descending=sort.descending,
+        limit=limit, cursor=cursor
+    )
+
+
 # Read a product by ID
 @router.get("/{product_id}", response_model=Product)
-async def read_product(product_id: ObjectId, req: Request):
-    product = await engine.find_one(Product, Product.id == product_id)
+async def read_product(product_id: ObjectId, req: Request, response: Response):
+    product = await get_product(product_id)
     if not product or (product.status == ProductStatus.DRAFT and "admin" not in req.state.user.roles):
         raise HTTPException(status_code=404, detail="Product not found")
 
+    not_modified = conditional_response(req, response, make_etag(product_version(product.id, product.updated_at)))
+    if not_modified:
+        return not_modified
+
     return product
 
 
 # Read all products
-@router.get("", response_model=List[Product])
-async def read_products(req: Request):
-    return await engine.find(
-        Product,
-        Product.status == ProductStatus.PUBLISHED if "admin" not in req.state.user.roles else {}
+@router.get("", response_model=Page[Product])
+async def read_products(
+        req: Request,
+        response: Response,
+        sort: ProductSort = ProductSort.NEWEST,
+        limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        cursor: Optional[str] = None,
+):
+    # Admin export of the whole catalog
+    if "admin" in req.state.user.roles and wants_ndjson(req):
+        return ndjson_response(Product, projection={"description_text": 0})
+
+    # Weak, stock and rating counts may lag behind the catalog version
+    etag = make_etag(
+        await get_catalog_version(), "admin" in req.state.user.roles, sort.value, limit, cursor, weak=True
     )
+    not_modified = conditional_response(req, response, etag)
+    if not_modified:
+        return not_modified
+
+    return await find_product_page(req, sort=sort, limit=limit, cursor=cursor)
 
 
 # Update a product by ID
@@ -78,19 +215,22 @@ async def update_product(product_id: ObjectId, product_data: UpdateProductReques
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
 
-    product.model_update(product_data)
-    await engine.save(product)
+    added_categories = set(product_data.category_names or []) - set(product.category_names)
+    changes = ChangeTracker(product)
 
-    # Handle category changes
-    if product_data.category_names:
-        categories = await engine.find(Category)
-        for category in categories:
-            if product_id in category.product_ids and category.name not in product_data.category_names:
-                category.product_ids.remove(product_id)
-            elif product_id not in category.product_ids and category.name in product_data.category_names:
-                category.product_ids.append(product_id)
+    product.model_update(product_data)
+    product.description_text = strip_html(product.description_html)
+    product.updated_at = datetime.datetime.now(datetime.UTC)
+    try:
+        await changes.save()
+    except errors.DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Product already exists")
+    await invalidate_products(product_id)
+    await bump_catalog_version()
 
-        await engine.save_all(categories)
+    # Membership is product.category_names itself, only new categories need creating
+    if added_categories:
+        await ensure_categories(added_categories)
 
 
 # Delete a product by ID
@@ -100,14 +240,9 @@ async def delete_product(product_id: ObjectId):
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
 
-    # Remove from categories
-    for name in product.category_names:
-        category = await engine.find_one(Category, Category.name == name)
-        if category:
-            category.product_ids.remove(product_id)
-            await engine.save(category)
-
     # reviews
-    await engine.delete_all(await engine.find(Review, Review.product_id == product_id))
+    await engine.remove(Review, Review.product == product_id)
 
     await engine.delete(product)
+    await invalidate_products(product_id)
+    await bump_catalog_version()
@@ -1,16 +1,21 @@
 import datetime
+from enum import Enum
 from typing import Optional, List
 
-from fastapi import APIRouter, HTTPException, Depends, Request, Body
+from fastapi import APIRouter, HTTPException, Depends, Request, Body, Response, Query
 from odmantic import ObjectId
 from pydantic import BaseModel
 
+from dependencies.etag import make_etag, conditional_response, bump_catalog_version, product_version
+from dependencies.pagination import (Page, encode_cursor, decode_cursor, keyset_query, cursor_value,
+                                     DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+from dependencies.product_cache import get_product, invalidate_products
+from dependencies.ratings import add_rating
 from dependencies.roles import role_admin
 from globals import engine
-from models import Review, Product, OrderStatus, Order, ProductStatus
+from models import Review, ReviewAuthor, OrderStatus, Order, Product, ProductStatus, User
 
 router = APIRouter(prefix="/reviews", tags=["reviews"])
-count_map = ["one", "two", "three", "four", "five"]
 
 
 class ReviewCreate(BaseModel):
@@ -36,69 +41,117 @@ class ReviewResponse(BaseModel):
     created_at: datetime.datetime
 
 
-async def user_qualified_for_review(user_id: ObjectId, product_id: ObjectId):
-    orders = await engine.find(
-        Order,
-        Order.user == user_id,
-        Order.status == OrderStatus.COMPLETED,
-        {"items.product_id": product_id},
-        {"items.review_id": None}
-    )
+class ReviewSort(str, Enum):
+    NEWEST = "newest"
+    RATING = "rating"
+
+    __keys__ = {
+        # sort: (key, descending)
+        NEWEST: ("created_at", True),
+        RATING: ("rating", True),
+    }
+
+    @property
+    def key(self):
+        return self.__keys__[self][0]  # noqa
+
+    @property
+    def descending(self):
+        return self.__keys__[self][1]  # noqa
+
 
-    return len(orders) > 0
+REVIEW_PROJECTION = {"user": 1, "author": 1, "rating": 1, "comment": 1, "created_at": 1}
 
 
-async def get_order_by_qualification(user_id: ObjectId, product_id: ObjectId):
-    orders = await engine.find(
-        Order,
-        Order.user == user_id,
-        Order.status == OrderStatus.COMPLETED,
-        {"items.product_id": product_id},
-        {"items.review_id": None}
+def review_author(first_name: str, last_name: Optional[str], thumbnail_url: Optional[str]) -> ReviewAuthor:
+    return ReviewAuthor(
+        full_name=first_name + (f" {last_name}" if last_name else ""),
+        thumbnail_url=thumbnail_url,
     )
 
-    return orders[0] if len(orders) > 0 else None
 
+async def to_review_responses(docs: List[dict]) -> List[ReviewResponse]:
+    # Reviews written before author snapshots existed, one query for all of them
+    missing = {doc["user"] for doc in docs if not doc.get("author")}
+    authors = {}
+    if missing:
+        users = engine.get_collection(User).find(
+            {"_id": {"$in": list(missing)}}, {"first_name": 1, "last_name": 1, "thumbnail_url": 1}
+        )
+        authors = {
+            user["_id"]: review_author(user["first_name"], user.get("last_name"), user.get("thumbnail_url")).model_dump()
+            async for user in users
+        }
+
+    deleted = ReviewAuthor(full_name="Deleted user").model_dump()
+    return [ReviewResponse(
+        **(doc.get("author") or authors.get(doc["user"], deleted)),
+        rating=doc["rating"],
+        comment=doc.get("comment"),
+        created_at=doc["created_at"],
+    ) for doc in docs]
+
+
+def qualifying_order_query(user_id: ObjectId, product_id: ObjectId) -> dict:
+    # A completed order holding the product that hasn't been reviewed yet, both on the same item
+    return {
+        "user": user_id,
+        "status": OrderStatus.COMPLETED,
+        "items": {"$elemMatch": {"product_id": product_id, "review_id": None}},
+    }
 
-def calculate_average_rating(product: Product):
-    product.rating.average = sum(
-        (i + 1) * getattr(product.rating, f"{count_map[i]}_star_count") for i in range(5)
-    ) / sum(getattr(product.rating, f"{count_map[i]}_star_count") for i in range(5))
+
+async def user_qualified_for_review(user_id: ObjectId, product_id: ObjectId):
+    orders = engine.get_collection(Order)
+    return await orders.count_documents(qualifying_order_query(user_id, product_id), limit=1) > 0
 
 
 @router.post("", status_code=201)
 async def create_review(req: Request, review: ReviewCreate):
     user = req.state.user
-    product: Product = await engine.find_one(
-        Product,
-        Product.id == review.product_id,
-        Product.status == ProductStatus.PUBLISHED)
-    if not user or not product:
+    product = await get_product(review.product_id)
+    if not user or not product or product.status != ProductStatus.PUBLISHED:
         raise HTTPException(status_code=404, detail="User or Product not found")
 
-    # Check has the user already reviewed the product
-    if not await user_qualified_for_review(user.id, review.product_id):
-        raise HTTPException(status_code=400, detail="not qualified for review")
-
-    new_review = Review(user=user, product=product, rating=review.rating, comment=review.comment)
-    await engine.save(new_review)
+    new_review = Review(
+        user=user,
+        product=product,
+        author=review_author(user.first_name, user.last_name, user.thumbnail_url),
+        rating=review.rating,
+        comment=review.comment,
+    )
 
-    product.reviews.append(new_review.id)
+    # Qualify and claim the order item in one go, a second concurrent review finds nothing left to claim
+    orders = engine.get_collection(Order)
+    claimed = await orders.find_one_and_update(
+        qualifying_order_query(user.id, product.id),
+        {"$set": {"items.$.review_id": new_review.id}},
+        projection={"_id": 1},
+    )
+    if not claimed:
+        raise HTTPException(status_code=400, detail="not qualified for review")
 
-    count_str = count_map[review.rating - 1]
-    # add the new review to the count_map
-    setattr(product.rating, f"{count_str}_star_count", getattr(product.rating, f"{count_str}_star_count") + 1)
+    try:
+        # Plain insert, engine.save would cascade and write back the (cached) product and user too
+        await engine.get_collection(Review).insert_one(new_review.model_dump_doc())
+    except Exception:
+        await orders.update_one(
+            {"_id": claimed["_id"], "items.review_id": new_review.id},
+            {"$set": {"items.$.review_id": None}},
+        )
+        raise
 
-    # calculate the average rating
-    calculate_average_rating(product)
+    average_changed = await add_rating(product.id, review.rating, 1)
+    await invalidate_products(product.id)
+    # Listings show the average, the counters alone are only exact on the product itself
+    if average_changed:
+        await bump_catalog_version()
 
-    order = await get_order_by_qualification(user.id, review.product_id)
-    if order:
-        order_item = next(filter(lambda x: x.product_id == product.id, order.items))
-        order_item.review_id = new_review.id
-        await engine.save(order)
 
-    await engine.save(product)
+async def read_review_version(product_id: ObjectId) -> Optional[dict]:
+    # Review writes always touch the product, its version covers the review list. Read from the database,
+    # not the product cache, which may be behind a review written through another instance
+    return await engine.get_collection(Product).find_one({"_id": product_id}, {"status": 1, "updated_at": 1})
 
 
 @router.get("/can-review", response_model=CanReviewResponse)
@@ -107,40 +160,66 @@ async def can_review(req: Request, product_id: ObjectId):
     return CanReviewResponse(qualified=await user_qualified_for_review(user.id, product_id))
 
 
-@router.get("/{product_id}", response_model=List[ReviewResponse], dependencies=[Depends(role_admin)])
-async def read_review(product_id: ObjectId):
-    reviews = await engine.find(Review, Review.product == product_id)
+# Public review feed, declared before /{product_id}
+@router.get("/product/{product_id}", response_model=Page[ReviewResponse])
+async def read_product_reviews(
+        product_id: ObjectId,
+        req: Request,
+        response: Response,
+        sort: ReviewSort = ReviewSort.NEWEST,
+        limit: int = Query(default=DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        cursor: Optional[str] = None,
+):
+    product = await read_review_version(product_id)
+    if not product or (product["status"] == ProductStatus.DRAFT and "admin" not in req.state.user.roles):
+        raise HTTPException(status_code=404, detail="Product not found")
+
+    etag = make_etag(product_version(product_id, product.get("updated_at")), sort.value, limit, cursor)
+    not_modified = conditional_response(req, response, etag)
+    if not_modified:
+        return not_modified
+
+    query = {"product": product_id}
+    if cursor:
+        value, last_id = decode_cursor(cursor, sort.value)
+        query.update(keyset_query(sort.key, value, last_id, sort.descending))
+
+    direction = -1 if sort.descending else 1
+    docs = await (
+        engine.get_collection(Review).find(query, REVIEW_PROJECTION)
+        .sort([(sort.key, direction), ("_id", direction)])
+        # One extra document to know whether there is a next page
+        .limit(limit + 1)
+        .to_list(length=None)
+    )
 
-    item = []
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = encode_cursor(sort.value, cursor_value(docs[-1], sort.key), docs[-1]["_id"])
 
-    for review in reviews:
-        item.append(ReviewResponse(
-            full_name=review.user.first_name + (f" {review.user.last_name}" if review.user.last_name else ""),
-            thumbnail_url=review.user.thumbnail_url,
-            rating=review.rating,
-            comment=review.comment,
-            created_at=review.created_at
-        ))
+    return Page(items=await to_review_responses(docs), next_cursor=next_cursor)
 
-    return item
+
+@router.get("/{product_id}", response_model=List[ReviewResponse], dependencies=[Depends(role_admin)])
+async def read_review(product_id: ObjectId, req: Request, response: Response):
+    product = await read_review_version(product_id)
+    if product:
+        etag = make_etag(product_version(product_id, product.get("updated_at")))
+        not_modified = conditional_response(req, response, etag)
+        if not_modified:
+            return not_modified
+
+    docs = await engine.get_collection(Review).find({"product": product_id}, REVIEW_PROJECTION).to_list(length=None)
+    return await to_review_responses(docs)
 
 
 @router.delete("/{review_id}", status_code=204, dependencies=[Depends(role_admin)])
 async def delete_review(review_id: ObjectId):
-    review = await engine.find_one(Review, Review.id == review_id)
+    review = await engine.get_collection(Review).find_one_and_delete({"_id": review_id}, {"product": 1, "rating": 1})
     if not review:
         raise HTTPException(status_code=404, detail="Review not found")
 
-    product = await engine.find_one(Product, Product.id == review.product.id)
-    if product:
-        product.reviews.remove(review.id)
-
-        count_str = count_map[review.rating - 1]
-        # remove the review from the count_map
-        setattr(product.rating, f"{count_str}_star_count", getattr(product.rating, f"{count_str}_star_count") - 1)
-
-        # calculate the average rating
-        calculate_average_rating(product)
-        await engine.save(product)
-
-    await engine.delete(review)
+    if await add_rating(review["product"], review["rating"], -1):
+        await bump_catalog_version()
+    await invalidate_products(review["product"])
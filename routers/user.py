@@ -1,11 +1,12 @@
 from typing import List
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
 from odmantic import ObjectId
 from pydantic import BaseModel
 from typing_extensions import Optional
 
-from dependencies.oauth import get_password_hash
+from dependencies.oauth import get_password_hash, invalidate_user
+from dependencies.streaming import wants_ndjson, ndjson_response
 from globals import engine
 from models import User, Cart, Address, Order
 
@@ -29,7 +30,10 @@ class UpdateRequest(BaseModel):
 
 
 @router.get("", response_model=List[User])
-async def get_all_users():
+async def get_all_users(req: Request):
+    if wants_ndjson(req):
+        return ndjson_response(User, projection={"password_hash": 0})
+
     return await engine.find(User)
 
 
@@ -62,7 +66,7 @@ async def update_user(user_id: ObjectId, user_data: UpdateRequest):
     user.model_update(user_data)
 
     if user_data.password:
-        user.password_hash = get_password_hash(user_data.password)
+        user.password_hash = await get_password_hash(user_data.password)
 
     if type(user_data.last_name) == str and not user_data.last_name:
         user.last_name = None
@@ -70,7 +74,8 @@ async def update_user(user_id: ObjectId, user_data: UpdateRequest):
     if type(user_data.thumbnail_url) == str and not user_data.thumbnail_url:
         user.thumbnail_url = None
 
-    await engine.save(user_data)
+    await engine.save(user)
+    invalidate_user(user.id)
 
 
 @router.delete("/{user_id}", status_code=204)
@@ -100,3 +105,4 @@ async def delete_user(user_id: ObjectId):
     # Feature: Review should be deleted by endpoint /reviews/{review_id} for re-calculating average rating
 
     await engine.delete(user)
+    invalidate_user(user.id)